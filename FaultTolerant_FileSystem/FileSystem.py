@@ -17,6 +17,7 @@ QR = 1
 QW = 1
 
 from ft_layer import *
+import ft_layer
 
 
 count = 0
@@ -87,6 +88,7 @@ class FileNode:
 
 
 class FS:
+    @batched
     def __init__(self,urls):
         self.urls = urls
         self.root = FileNode('/',False,'/',urls)
@@ -129,6 +131,7 @@ class FS:
             self.fd+=1
             return self.fd
 
+    @batched
     def add_dir(self,path,mode):
         # create a file node
         temp_node = FileNode(path.split('/')[-1],False,path,self.urls)
@@ -139,6 +142,7 @@ class FS:
         self.add_node(temp_node,path)
   
 
+    @batched
     def add_file(self,path,mode):
         # create a file node
         temp_node = FileNode(path.split('/')[-1],True,path,self.urls)
@@ -151,6 +155,7 @@ class FS:
         self.fd+=1
         return self.fd
 
+    @batched
     def write_file(self,path,data=None, offset=0, fh=None):
         # file will already have been created before this call
         # get the corresponding file node
@@ -179,6 +184,7 @@ class FS:
             # return requested portion data
             return filenode.get("data")[offset:offset + size]
 
+    @batched
     def rename_node(self,old,new):
         # first check if parent exists i.e. destination path is valid
         future_parent_node = self.get_parent_node(new)
@@ -201,6 +207,7 @@ class FS:
         filenode.name = new.split('/')[-1]
         future_parent_node.add_node(filenode)
 
+    @batched
     def utimens(self,path,times):
         filenode = self.get_node_wrapper(path)
         now = time()
@@ -211,6 +218,7 @@ class FS:
         filenode.put("meta",meta)
 
 
+    @batched
     def delete_node(self,path):
         # get parent node
         parent_filenode = self.get_parent_node(path)
@@ -226,6 +234,7 @@ class FS:
             parents_meta["st_nlink"]-=1
             parent_filenode.put("meta",parents_meta)
 
+    @batched
     def link_nodes(self,target,source):
         # create a new target node.
         temp_node = FileNode(target.split('/')[-1],True,target,self.urls)
@@ -235,6 +244,7 @@ class FS:
         # add the new node to FS
         self.add_node(temp_node,target)
 
+    @batched
     def update_meta(self,path,mode=None,uid=None,gid=None):
         # get the desired filenode.
         filenode = self.get_node_wrapper(path)
@@ -403,8 +413,21 @@ class Memory(LoggingMixIn, Operations):
         
 
 if __name__ == "__main__":
-  if len(argv) < 6:
-    print 'usage: %s <mountpoint> <QR> <QW> <meta server hashtable> <data servers>' % argv[0]
+  # optional --compress=<0-9> sets the compression level of stored values,
+  # --meta-shards=N takes the first N servers as meta server shards,
+  # --leases caches what is read under metaserver leases
+  for arg in argv[1:]:
+    if arg.startswith("--compress="):
+      ft_layer.COMPRESS_LEVEL = int(arg.split("=",1)[1])
+      argv.remove(arg)
+    elif arg.startswith("--meta-shards="):
+      ft_layer.META_SHARDS = int(arg.split("=",1)[1])
+      argv.remove(arg)
+    elif arg == "--leases":
+      ft_layer.enable_leases()
+      argv.remove(arg)
+  if len(argv) < 5 + ft_layer.META_SHARDS:
+    print 'usage: %s [--compress=N] [--meta-shards=N] [--leases] <mountpoint> <QR> <QW> <meta server hashtables> <data servers>' % argv[0]
     exit(1)
   global QR
   global QW
@@ -413,10 +436,17 @@ if __name__ == "__main__":
   urls = []
   ports = [] 
   ports = argv[4:]
-  print "META SERVER: ", ports[0], "DATA SERVER: ", ports[1:]
+  print "META SERVER: ", ports[:ft_layer.META_SHARDS], "DATA SERVER: ", ports[ft_layer.META_SHARDS:]
   for port in ports:
-      url = "http://localhost:" + port
-      urls.append(url)
+      # full urls (e.g. bin://localhost:52235) are taken as they are, a
+      # replicated meta server is given as a comma separated group
+      group = []
+      for member in port.split(","):
+          if "://" in member:
+              group.append(member)
+          else:
+              group.append("http://localhost:" + member)
+      urls.append(",".join(group))
   
   # Create a new HtProxy object using the urls specified at the command-line
   fuse = FUSE(Memory(urls), argv[1], foreground=True,debug=False)
@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+Description:
+Length-prefixed binary transport for SimpleHT.  It runs beside the XmlRpc
+endpoint of a data or meta server and is selected by clients through a
+bin://host:port url.  Values travel as raw bytes, with no base64 or XML
+encoding in between.
+
+Every request is a single frame:
+  header  !IBIIi  request id, opcode, key length, value length, ttl
+  body    key bytes followed by value bytes
+Every reply is a single frame:
+  header  !IBIi   request id, status, value length, ttl
+  body    value bytes
+
+  GET   replies OK with the value and remaining ttl, or MISS with no body
+  PUT   replies OK with no body
+
+Requests are pipelined: a client may write any number of frames before
+reading a reply, and replies are matched to requests by id rather than by
+order, so many threads can share one connection.
+"""
+
+import socket, struct, select, threading
+from xmlrpclib import Binary
+
+SCHEME = "bin://"
+
+OP_GET = 1
+OP_PUT = 2
+
+ST_OK = 0
+ST_MISS = 1
+ST_ERROR = 2
+
+REQ_HDR = struct.Struct("!IBIIi")
+REP_HDR = struct.Struct("!IBIi")
+
+# Below this size the header and the payload are sent as one buffer,
+# above it the payload goes out straight from a memoryview
+COALESCE_LIMIT = 64 * 1024
+RECV_SIZE = 256 * 1024
+
+
+def send_frame(sock, header, payload):
+  if len(payload) <= COALESCE_LIMIT:
+    sock.sendall(header + payload)
+  else:
+    sock.sendall(header)
+    sock.sendall(memoryview(payload))
+
+def recv_exact(sock, size):
+  buf = bytearray(size)
+  view = memoryview(buf)
+  got = 0
+  while got < size:
+    n = sock.recv_into(view[got:], size - got)
+    if n == 0:
+      raise socket.error("connection closed by peer")
+    got += n
+  return buf
+
+def parse_url(url):
+  host, port = url[len(SCHEME):].rstrip("/").rsplit(":", 1)
+  return host, int(port)
+
+
+# Server side: one listening socket plus the accepted connections, all
+# driven from the owner's select loop so SimpleHT stays single-threaded
+class FrameServer:
+  # reuse_port lets several worker processes listen on the same port
+  def __init__(self, sht, port, reuse_port=False):
+    self.sht = sht
+    self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+      self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    self.listener.bind(('', port))
+    self.listener.listen(64)
+    self.conns = {}
+
+  # Wait until something is readable, serve our own sockets and return
+  # the entries of others that are ready
+  def poll(self, others, timeout=None):
+    socks = [self.listener] + self.conns.keys() + list(others)
+    ready = select.select(socks, [], [], timeout)[0]
+    rest = []
+    for sock in ready:
+      if sock is self.listener:
+        self.accept()
+      elif sock in self.conns:
+        self.serve_conn(sock)
+      else:
+        rest.append(sock)
+    return rest
+
+  def accept(self):
+    sock, addr = self.listener.accept()
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.conns[sock] = bytearray()
+
+  def drop(self, sock):
+    del self.conns[sock]
+    sock.close()
+
+  def serve_conn(self, sock):
+    try:
+      chunk = sock.recv(RECV_SIZE)
+    except socket.error:
+      chunk = ""
+    if not chunk:
+      self.drop(sock)
+      return
+    buf = self.conns[sock]
+    buf.extend(chunk)
+    view = memoryview(buf)
+    pos = 0
+    try:
+      while len(buf) - pos >= REQ_HDR.size:
+        rid, op, klen, vlen, ttl = REQ_HDR.unpack_from(buf, pos)
+        end = pos + REQ_HDR.size + klen + vlen
+        if len(buf) < end:
+          break
+        kpos = pos + REQ_HDR.size
+        key = view[kpos:kpos + klen].tobytes()
+        value = view[kpos + klen:end].tobytes()
+        pos = end
+        self.dispatch(sock, rid, op, key, value, ttl)
+    except socket.error:
+      del view
+      self.drop(sock)
+      return
+    # the view pins the buffer, let go of it before trimming
+    del view
+    del buf[:pos]
+
+  # A request the table refuses (say a put on a backup meta server) is
+  # answered with ST_ERROR instead of taking the server down
+  def dispatch(self, sock, rid, op, key, value, ttl):
+    try:
+      if op == OP_GET:
+        rv = self.sht.get(Binary(key))
+      elif op == OP_PUT:
+        self.sht.put(Binary(key), Binary(value), ttl)
+        rv = None
+      else:
+        raise ValueError("unknown opcode %d" % op)
+    except socket.error:
+      raise
+    except Exception:
+      sock.sendall(REP_HDR.pack(rid, ST_ERROR, 0, 0))
+      return
+    if rv is None:
+      sock.sendall(REP_HDR.pack(rid, ST_OK, 0, 0))
+    elif "value" in rv:
+      payload = rv["value"].data
+      send_frame(sock, REP_HDR.pack(rid, ST_OK, len(payload), rv["ttl"]), payload)
+    else:
+      sock.sendall(REP_HDR.pack(rid, ST_MISS, 0, 0))
+
+  def close(self):
+    for sock in self.conns.keys():
+      self.drop(sock)
+    self.listener.close()
+
+
+# Persistent connections shared by every proxy pointing at the same server
+_pool = {}
+_pool_lock = threading.Lock()
+
+# An outstanding request, completed by the connection's reader thread.  A
+# caller that gives up on it takes it out of the connection's pending
+class Pending:
+  def __init__(self, rid, conn):
+    self.rid = rid
+    self.conn = conn
+    self.done = threading.Event()
+    self.reply = None
+    self.error = None
+
+  def complete(self, reply=None, error=None):
+    self.reply = reply
+    self.error = error
+    self.done.set()
+
+  def wait(self, timeout=None):
+    if not self.done.wait(timeout):
+      self.conn.abandon(self)
+      raise socket.timeout("no reply to request %d" % self.rid)
+    if self.error is not None:
+      raise self.error
+    return self.reply
+
+class _Connection:
+  def __init__(self, addr):
+    self.addr = addr
+    self.sock = None
+    self.next_id = 0
+    self.pending = {}
+    # lock guards sock, next_id and pending; send_lock only keeps frames
+    # from interleaving, so the reader never waits behind a large send
+    self.lock = threading.Lock()
+    self.send_lock = threading.Lock()
+
+  def connect(self):
+    sock = socket.create_connection(self.addr)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.sock = sock
+    reader = threading.Thread(target=self.read_replies, args=(sock, ))
+    reader.setDaemon(True)
+    reader.start()
+
+  def submit(self, op, key, value, ttl):
+    with self.lock:
+      if self.sock is None:
+        self.connect()
+      sock = self.sock
+      self.next_id = (self.next_id + 1) & 0xffffffff
+      req = Pending(self.next_id, self)
+      self.pending[req.rid] = req
+    try:
+      with self.send_lock:
+        send_frame(sock, REQ_HDR.pack(req.rid, op, len(key), len(value), ttl) + key, value)
+    except socket.error, e:
+      with self.lock:
+        self.fail(sock, e)
+    return req
+
+  def read_replies(self, sock):
+    try:
+      while True:
+        rid, status, vlen, ttl = REP_HDR.unpack(bytes(recv_exact(sock, REP_HDR.size)))
+        payload = bytes(recv_exact(sock, vlen)) if vlen else ""
+        with self.lock:
+          req = self.pending.pop(rid, None)
+        if req is not None:
+          req.complete((status, payload, ttl))
+    except socket.error, e:
+      with self.lock:
+        self.fail(sock, e)
+
+  # A late reply to it is then dropped by the reader
+  def abandon(self, req):
+    with self.lock:
+      if self.pending.get(req.rid) is req:
+        del self.pending[req.rid]
+
+  # Drop a broken socket and error out whatever was waiting on it,
+  # the next submit reconnects.  Called with the lock held.
+  def fail(self, sock, error):
+    if self.sock is not sock:
+      return
+    self.sock = None
+    sock.close()
+    for req in self.pending.values():
+      req.complete(error=error)
+    self.pending = {}
+
+def _connection(addr):
+  with _pool_lock:
+    if addr not in _pool:
+      _pool[addr] = _Connection(addr)
+    return _pool[addr]
+
+
+# Client side: same get / put signatures as an xmlrpclib.Server for SimpleHT.
+# The *_async variants return a Pending without waiting, and get_many /
+# put_many keep a whole batch in flight on the one connection.
+class FrameProxy:
+  def __init__(self, url, timeout=None):
+    self.conn = _connection(parse_url(url))
+    self.timeout = timeout
+
+  def get_async(self, key):
+    return self.conn.submit(OP_GET, key.data, "", 0)
+
+  def put_async(self, key, value, ttl):
+    return self.conn.submit(OP_PUT, key.data, value.data, ttl)
+
+  def get_result(self, req):
+    status, payload, ttl = req.wait(self.timeout)
+    if status == ST_OK:
+      return {"value": Binary(payload), "ttl": ttl}
+    if status == ST_MISS:
+      return {}
+    raise socket.error("get failed on %s:%d" % self.conn.addr)
+
+  def put_result(self, req):
+    status, payload, ttl = req.wait(self.timeout)
+    if status != ST_OK:
+      raise socket.error("put failed on %s:%d" % self.conn.addr)
+    return True
+
+  def get(self, key):
+    return self.get_result(self.get_async(key))
+
+  def put(self, key, value, ttl):
+    return self.put_result(self.put_async(key, value, ttl))
+
+  def get_many(self, keys):
+    reqs = [self.get_async(key) for key in keys]
+    return [self.get_result(req) for req in reqs]
+
+  def put_many(self, items, ttl):
+    reqs = [self.put_async(key, value, ttl) for key, value in items]
+    return [self.put_result(req) for req in reqs]
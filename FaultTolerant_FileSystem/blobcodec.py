@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Optional compression of the pickled values stored on the data servers.
+
+A compressed value is FLAG followed by one method byte and the compressed
+bytes.  A pickle never starts with FLAG, so anything without it is an old
+uncompressed value and is returned untouched by decode().
+
+The method is picked per value:
+  - values under MIN_SIZE are stored as they are
+  - a zlib level 1 probe of the first SAMPLE bytes must shrink them to
+    MAX_RATIO or better, otherwise the value is stored as it is
+  - values of LZMA_SIZE and up use lzma when it is importable, the rest zlib
+The result is only kept if it is smaller than the input.
+"""
+
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+FLAG = "\x00"
+ZLIB = "z"
+LZMA = "x"
+
+MIN_SIZE = 512
+SAMPLE = 16 * 1024
+MAX_RATIO = 0.9
+LZMA_SIZE = 1024 * 1024
+
+# 0 turns compression off, 1-9 trade speed for size
+DEFAULT_LEVEL = 6
+
+
+def encode(raw, level=DEFAULT_LEVEL):
+    if level <= 0 or len(raw) < MIN_SIZE:
+        return raw
+    sample = raw[:SAMPLE]
+    if len(zlib.compress(sample, 1)) > len(sample) * MAX_RATIO:
+        return raw
+    if lzma is not None and len(raw) >= LZMA_SIZE:
+        packed = FLAG + LZMA + lzma.compress(raw, preset=min(level, 9))
+    else:
+        packed = FLAG + ZLIB + zlib.compress(raw, min(level, 9))
+    if len(packed) >= len(raw):
+        return raw
+    return packed
+
+
+def decode(blob):
+    if not blob.startswith(FLAG):
+        return blob
+    method = blob[1:2]
+    if method == ZLIB:
+        return zlib.decompress(blob[2:])
+    if method == LZMA:
+        if lzma is None:
+            raise IOError("value is lzma compressed but lzma is not available")
+        return lzma.decompress(blob[2:])
+    raise IOError("unknown compression method %r" % method)
@@ -16,36 +16,271 @@ The XmlRpc API for this library is:
     Inserts the key / value pair into the hashtable, using the same key will
       over-write existing values
     Example usage:  rpc.put(Binary("key"), Binary("value"), 1000)
+  put_many(list items, int ttl)
+    put of every [base64 key, base64 value] pair in items, in one request;
+      returns a list of True
   print_content()
     Print the contents of the HT
+  scan(base64 prefix, base64 start_after, int limit)
+    Returns {"keys": [Binary, ...], "more": bool}, the keys under prefix
+      that sort after start_after, in order, at most limit of them
+    Example usage:  rpc.scan(Binary("/dir/"), Binary(""), 1000)
+  stats()
+    Returns the key count, bytes held, memory cap, policy and evictions
   read_file(string filename)
     Store the contents of the Hahelperable into a file
   write_file(string filename)
     Load the contents of the file into the Hahelperable
+  snapshot(base64 filename[, bool mapped])
+    Like write_file, but the file is written by a forked child while the
+      server keeps answering; returns False if one is already running.
+      With mapped set the file is in the write_mmap layout
+  write_mmap(base64 filename)
+    Write the contents as a hash indexed table (mmapstore.py)
+  open_mmap(base64 filename)
+    Replace the contents with a write_mmap table, served from an mmap of
+      the file and paged in as keys are read
+  snapshot_status()
+    Returns {"running": bool, "result": "ok" | "failed" | ""}
+
+The get and put calls are also served over the framed socket transport in
+binproto.py when the server is started with a binary port.
 """
 
 import sys, SimpleXMLRPCServer, getopt, pickle, time, threading, xmlrpclib, unittest
 from datetime import datetime, timedelta
 from xmlrpclib import Binary
 from multiprocessing import Pool
-import signal
+from collections import OrderedDict
+from array import array
+from bisect import bisect_left, bisect_right
+import signal, heapq, shelve, os, glob, socket, hashlib, SocketServer
+import binproto, mmapstore
+
+
+# Seconds between sweeps for expired entries
+CHECK_INTERVAL = 5 * 60
+
+# Snapshot files start with this marker, then hold pickled lists of up to
+# SNAPSHOT_CHUNK (key, value, expiry) entries, ended by an empty list
+SNAPSHOT_MAGIC = "SimpleHT-snapshot-1"
+SNAPSHOT_CHUNK = 1024
+
+# Sorted set of keys kept as a list of sorted chunks, so an insert or
+# delete shifts at most 2 * LOAD entries instead of the whole key list
+class SortedKeys:
+  LOAD = 512
+
+  def __init__(self):
+    self.chunks = []
+    self.maxes = []
+    self.size = 0
+
+  def __len__(self):
+    return self.size
+
+  def add(self, key):
+    if not self.chunks:
+      self.chunks.append([key])
+      self.maxes.append(key)
+      self.size = 1
+      return
+    i = min(bisect_left(self.maxes, key), len(self.maxes) - 1)
+    chunk = self.chunks[i]
+    j = bisect_left(chunk, key)
+    if j < len(chunk) and chunk[j] == key:
+      return
+    chunk.insert(j, key)
+    self.maxes[i] = chunk[-1]
+    self.size += 1
+    if len(chunk) > 2 * self.LOAD:
+      self.chunks[i:i + 1] = [chunk[:self.LOAD], chunk[self.LOAD:]]
+      self.maxes[i:i + 1] = [chunk[self.LOAD - 1], chunk[-1]]
+
+  def discard(self, key):
+    i = bisect_left(self.maxes, key)
+    if i == len(self.maxes):
+      return
+    chunk = self.chunks[i]
+    j = bisect_left(chunk, key)
+    if j == len(chunk) or chunk[j] != key:
+      return
+    del chunk[j]
+    self.size -= 1
+    if chunk:
+      self.maxes[i] = chunk[-1]
+    else:
+      del self.chunks[i]
+      del self.maxes[i]
+
+  # Keys from lo onwards in order, lo itself only if inclusive
+  def iter_from(self, lo, inclusive=True):
+    find = bisect_left if inclusive else bisect_right
+    i = find(self.maxes, lo)
+    if i == len(self.maxes):
+      return
+    for key in self.chunks[i][find(self.chunks[i], lo):]:
+      yield key
+    for chunk in self.chunks[i + 1:]:
+      for key in chunk:
+        yield key
+
+# XmlRpc server answering each request in its own thread
+class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
+  daemon_threads = True
+
+# XmlRpc server sharing its port with the other workers of a data server
+class ReusePortXMLRPCServer(SimpleXMLRPCServer.SimpleXMLRPCServer):
+  def server_bind(self):
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    SimpleXMLRPCServer.SimpleXMLRPCServer.server_bind(self)
 
+# Every call on a SimpleHT made under one lock
+class LockedHT:
+  def __init__(self, sht, lock):
+    self.sht = sht
+    self.lock = lock
+
+  def __getattr__(self, name):
+    fn = getattr(self.sht, name)
+    def call(*args):
+      with self.lock:
+        return fn(*args)
+    return call
+
+# One of the K worker processes behind a data server port (--workers=K).
+# The kernel spreads connections over the workers through SO_REUSEPORT
+# and each worker owns the keys whose md5 lands on it.  get and put of
+# any other key are forwarded to the owner's private binary port, scan
+# merges a page from every worker, and everything else acts on this
+# worker's own partition.  Worker i listens privately on
+# port + offset + 2i (XmlRpc) and the port after it (binary), served from
+# their own threads, which is why the table is only touched under a lock.
+class Partition:
+  def __init__(self, sht, port, workers, worker, offset):
+    self.local = LockedHT(sht, threading.Lock())
+    self.workers = workers
+    self.worker = worker
+    self.private = [port + offset + 2 * i for i in range(workers)]
+    self.peers = [binproto.FrameProxy("bin://127.0.0.1:%d" % (p + 1)) for p in self.private]
+
+  def __getattr__(self, name):
+    return getattr(self.local, name)
+
+  def start(self):
+    port = self.private[self.worker]
+    rpc_server = ThreadedXMLRPCServer(('127.0.0.1', port), logRequests = False)
+    rpc_server.register_function(self.local.scan, "scan")
+    rpc_thread = threading.Thread(target=rpc_server.serve_forever)
+    rpc_thread.setDaemon(True)
+    rpc_thread.start()
+    frame_server = binproto.FrameServer(self.local, port + 1)
+    def frame_loop():
+      while True:
+        frame_server.poll([])
+    frame_thread = threading.Thread(target=frame_loop)
+    frame_thread.setDaemon(True)
+    frame_thread.start()
+
+  def owner(self, key):
+    return int(hashlib.md5(key).hexdigest()[:8], 16) % self.workers
+
+  def get(self, key):
+    i = self.owner(key.data)
+    if i == self.worker:
+      return self.local.get(key)
+    return self.peers[i].get(key)
+
+  def put(self, key, value, ttl):
+    i = self.owner(key.data)
+    if i == self.worker:
+      return self.local.put(key, value, ttl)
+    return self.peers[i].put(key, value, ttl)
+
+  # one put_many for the local keys, the forwarded ones all in flight at once
+  def put_many(self, items, ttl):
+    local = []
+    reqs = []
+    for key, value in items:
+      i = self.owner(key.data)
+      if i == self.worker:
+        local.append((key, value))
+      else:
+        reqs.append((self.peers[i], self.peers[i].put_async(key, value, ttl)))
+    self.local.put_many(local, ttl)
+    for peer, req in reqs:
+      peer.put_result(req)
+    return [True] * len(items)
+
+  def scan(self, prefix, start_after, limit):
+    pages = [self.local.scan(prefix, start_after, limit)]
+    for i, port in enumerate(self.private):
+      if i != self.worker:
+        pages.append(xmlrpclib.Server("http://127.0.0.1:%d" % port).scan(prefix, start_after, limit))
+    keys = sorted((key for page in pages for key in page["keys"]), key = lambda key: key.data)
+    return {"keys": keys[:limit],
+            "more": len(keys) > limit or any(page["more"] for page in pages)}
 
 def init_worker():
   signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 # Presents a HT interface
+#
+# max_bytes caps the key + value bytes held in memory (0 leaves it
+# unbounded).  Once over the cap entries are evicted by policy:
+#   lru    least recently used first, for cache roles
+#   lfu    least frequently used first, for cache roles
+#   spill  least recently used first, but moved to a shelve file at
+#          spill_path instead of dropped, for storage roles
+#
+# Values live in data as plain strings.  Expiry times are epoch floats in
+# the expiry array, at the slot that slots maps the key to; freed slots are
+# reused so the array only grows with the peak number of keys.
 class SimpleHT:
-  def __init__(self):
+  def __init__(self, max_bytes=0, policy="lru", spill_path=None):
     self.quit =0;
     self.data = {}
-    self.next_check = datetime.now() + timedelta(minutes = 5)
+    self.slots = {}
+    self.expiry = array('d')
+    self.free_slots = []
+    # every live key, in memory or spilled, for scan
+    self.index = SortedKeys()
+    self.next_check = time.time() + CHECK_INTERVAL
+    # background snapshot child, and how the last one ended
+    self.snapshot_pid = 0
+    self.snapshot_result = ""
+    if policy not in ("lru", "lfu", "spill"):
+      raise ValueError("unknown eviction policy %s" % policy)
+    if policy == "spill" and spill_path is None:
+      raise ValueError("spill policy needs a spill_path")
+    self.max_bytes = max_bytes
+    self.policy = policy
+    self.used_bytes = 0
+    self.evictions = 0
+    # recency order for lru / spill, and use counts with a lazily cleaned
+    # heap of (uses, tick, key) for lfu; all stay empty without a cap so
+    # an uncapped table holds nothing per key beyond data, slots and index
+    self.recency = OrderedDict()
+    self.uses = {}
+    self.heap = []
+    self.tick = 0
+    self.spill = None
+    if policy == "spill":
+      self.spill = shelve.open(spill_path, "n", protocol = 2)
+    # a mapped table (mmapstore) served underneath the in-memory entries,
+    # and the keys of it that have since been written again
+    self.base = None
+    self.shadowed = set()
 
   def count(self):
     # Remove expired entries
-    self.next_check = datetime.now() - timedelta(minutes = 5)
+    self.next_check = 0
     self.check()
-    return len(self.data)
+    n = len(self.data) + (len(self.spill) if self.spill is not None else 0)
+    if self.base is not None:
+      # expired entries of the mapped table are counted until rewritten
+      n += len(self.base) - len(self.shadowed)
+    return n
 
   # Retrieve something from the HT
   def get(self, key):
@@ -55,38 +290,294 @@ class SimpleHT:
     rv = {}
     # If the key is in the data structure, return properly formated results
     key = key.data
+    if key not in self.data:
+      self.unspill(key)
+    now = time.time()
     if key in self.data:
-      ent = self.data[key]
-      now = datetime.now()
-      if ent[1] > now:
-        ttl = (ent[1] - now).seconds
-        rv = {"value": Binary(ent[0]), "ttl": ttl}
+      end = self.expiry[self.slots[key]]
+      if end > now:
+        rv = {"value": Binary(self.data[key]), "ttl": int(end - now)}
+        self.touch(key)
       else:
-        del self.data[key]
+        self.remove(key)
+        self.index.discard(key)
+    elif self.base is not None and key not in self.shadowed:
+      found = self.base.lookup(key)
+      if found is not None and found[1] > now:
+        rv = {"value": Binary(found[0]), "ttl": int(found[1] - now)}
     return rv
 
   # Insert something into the HT
   def put(self, key, value, ttl):
     # Remove expired entries
     self.check()
-    end = datetime.now() + timedelta(seconds = ttl)
-    self.data[key.data] = (value.data, end)
+    end = time.time() + ttl
+    self.store(key.data, value.data, end)
     return True
-    
-  # Load contents from a file
+
+  def put_many(self, items, ttl):
+    return [self.put(key, value, ttl) for key, value in items]
+
+  # Bytes an entry is charged for
+  def entry_size(self, key, value):
+    return len(key) + len(value)
+
+  def store(self, key, value, end):
+    if key in self.data:
+      self.remove(key)
+    elif self.spill is not None and key in self.spill:
+      del self.spill[key]
+    elif self.base is not None and key not in self.shadowed and key in self.base:
+      self.shadowed.add(key)
+    self.data[key] = value
+    if self.free_slots:
+      slot = self.free_slots.pop()
+      self.expiry[slot] = end
+    else:
+      slot = len(self.expiry)
+      self.expiry.append(end)
+    self.slots[key] = slot
+    self.index.add(key)
+    self.used_bytes += self.entry_size(key, value)
+    self.touch(key)
+    self.enforce_cap(key)
+
+  def remove(self, key):
+    value = self.data.pop(key)
+    self.free_slots.append(self.slots.pop(key))
+    self.used_bytes -= self.entry_size(key, value)
+    if self.max_bytes:
+      self.recency.pop(key, None)
+      self.uses.pop(key, None)
+
+  # Recency and use counts only matter for eviction, so an uncapped table
+  # keeps none
+  def touch(self, key):
+    if not self.max_bytes:
+      return
+    if self.policy == "lfu":
+      self.tick += 1
+      self.uses[key] = self.uses.get(key, 0) + 1
+      heapq.heappush(self.heap, (self.uses[key], self.tick, key))
+      # stale heap entries pile up with every hit, rebuild now and then
+      if len(self.heap) > 4 * len(self.data) + 64:
+        self.heap = [(n, 0, k) for k, n in self.uses.iteritems()]
+        heapq.heapify(self.heap)
+    else:
+      self.recency.pop(key, None)
+      self.recency[key] = None
+
+  # Next entry to evict, other than skip
+  def victim(self, skip):
+    if self.policy == "lfu":
+      held = None
+      found = None
+      while self.heap:
+        item = heapq.heappop(self.heap)
+        uses, tick, key = item
+        if self.uses.get(key) != uses:
+          continue
+        if key == skip:
+          held = item
+          continue
+        found = key
+        break
+      if held is not None:
+        heapq.heappush(self.heap, held)
+      return found
+    for key in self.recency:
+      if key != skip:
+        return key
+    return None
+
+  # Evict until under the cap, never evicting the entry just written
+  def enforce_cap(self, keep):
+    if not self.max_bytes:
+      return
+    while self.used_bytes > self.max_bytes:
+      key = self.victim(keep)
+      if key is None:
+        break
+      if self.spill is not None:
+        self.spill[key] = (self.data[key], self.expiry[self.slots[key]])
+      else:
+        self.index.discard(key)
+      self.remove(key)
+      self.evictions += 1
+
+  # Bring a spilled entry back into memory
+  def unspill(self, key):
+    if self.spill is None or key not in self.spill:
+      return
+    value, end = self.spill.pop(key)
+    if end > time.time():
+      self.store(key, value, end)
+    else:
+      self.index.discard(key)
+
+  # All live entries as (key, value, expiry), in memory, spilled and mapped
+  def iter_entries(self):
+    now = time.time()
+    for key, value in self.data.iteritems():
+      end = self.expiry[self.slots[key]]
+      if end > now:
+        yield key, value, end
+    if self.spill is not None:
+      for key in self.spill.keys():
+        value, end = self.spill[key]
+        if end > now:
+          yield key, value, end
+    if self.base is not None:
+      for key, value, end in self.base.iteritems():
+        if end > now and key not in self.shadowed:
+          yield key, value, end
+
+  # Every key, expired or not, from lo onwards in order
+  def iter_keys(self, lo, inclusive=True):
+    keys = self.index.iter_from(lo, inclusive)
+    if self.base is None:
+      return keys
+    mapped = (k for k in self.base.iter_from(lo, inclusive) if k not in self.shadowed)
+    return heapq.merge(keys, mapped)
+
+  # (value, expiry) of key wherever it is held, or None
+  def lookup(self, key):
+    if key in self.data:
+      return self.data[key], self.expiry[self.slots[key]]
+    if self.spill is not None and key in self.spill:
+      return self.spill[key]
+    if self.base is not None and key not in self.shadowed:
+      return self.base.lookup(key)
+    return None
+
+  # Drop every entry, in memory, spilled and mapped
+  def reset(self):
+    self.data = {}
+    self.slots = {}
+    self.expiry = array('d')
+    self.free_slots = []
+    self.index = SortedKeys()
+    self.used_bytes = 0
+    self.recency.clear()
+    self.uses = {}
+    self.heap = []
+    if self.spill is not None:
+      self.spill.clear()
+    if self.base is not None:
+      self.base.close()
+      self.base = None
+    self.shadowed = set()
+
+  # Write the live entries as a table that open_mmap can serve directly
+  def write_mmap(self, filename):
+    self.check()
+    now = time.time()
+    def live():
+      for key in self.iter_keys(""):
+        found = self.lookup(key)
+        if found is not None and found[1] > now:
+          yield key, found[0], found[1]
+    mmapstore.write_table(filename.data, live())
+    return True
+
+  # Replace the contents with a table written by write_mmap.  The file is
+  # mapped, not read, so this takes the same time for any table size;
+  # later puts are kept in memory on top of it.
+  def open_mmap(self, filename):
+    base = mmapstore.MappedTable(filename.data)
+    self.reset()
+    self.base = base
+    return True
+
+  # Load contents from a file, a chunk at a time
   def read_file(self, filename):
     f = open(filename.data, "rb")
-    self.data = pickle.load(f)
+    unpickler = pickle.Unpickler(f)
+    first = unpickler.load()
+    self.reset()
+    if first == SNAPSHOT_MAGIC:
+      while True:
+        chunk = unpickler.load()
+        if not chunk:
+          break
+        for key, value, end in chunk:
+          self.store(key, value, end)
+        # the writer clears its memo after every chunk
+        unpickler.memo.clear()
+    else:
+      # a whole-table dict, as written before snapshots were streamed
+      for key, (value, end) in first.iteritems():
+        # files written before expiry times were floats hold datetimes
+        if isinstance(end, datetime):
+          end = time.mktime(end.timetuple()) + end.microsecond / 1e6
+        self.store(key, value, end)
     f.close()
     return True
 
   # Write contents to a file
   def write_file(self, filename):
-    f = open(filename.data, "wb")
-    pickle.dump(self.data, f)
+    self.dump(filename.data)
+    return True
+
+  # Stream the live entries to filename in chunks of SNAPSHOT_CHUNK, so
+  # memory use stays flat.  The data goes to a temporary file first and is
+  # renamed into place, a reader never sees a half written snapshot.
+  def dump(self, filename):
+    tmp = filename + ".tmp"
+    f = open(tmp, "wb")
+    pickler = pickle.Pickler(f, 2)
+    pickler.dump(SNAPSHOT_MAGIC)
+    chunk = []
+    for entry in self.iter_entries():
+      chunk.append(entry)
+      if len(chunk) == SNAPSHOT_CHUNK:
+        pickler.dump(chunk)
+        pickler.clear_memo()
+        chunk = []
+    if chunk:
+      pickler.dump(chunk)
+    pickler.dump([])
+    f.flush()
+    os.fsync(f.fileno())
     f.close()
+    os.rename(tmp, filename)
+
+  # Write a snapshot in the background.  A forked child dumps its
+  # copy-on-write view of the table while this process keeps serving.
+  # Spilled entries are read from the shared spill file, so they may
+  # include writes made after the fork.  With mapped set the child writes
+  # the write_mmap layout.  Returns False if a snapshot is still running.
+  def snapshot(self, filename, mapped=False):
+    self.reap_snapshot()
+    if self.snapshot_pid:
+      return False
+    pid = os.fork()
+    if pid == 0:
+      code = 1
+      try:
+        if mapped:
+          self.write_mmap(filename)
+        else:
+          self.dump(filename.data)
+        code = 0
+      finally:
+        os._exit(code)
+    self.snapshot_pid = pid
+    self.snapshot_result = ""
     return True
 
+  def reap_snapshot(self):
+    if not self.snapshot_pid:
+      return
+    pid, status = os.waitpid(self.snapshot_pid, os.WNOHANG)
+    if pid:
+      self.snapshot_pid = 0
+      self.snapshot_result = "ok" if status == 0 else "failed"
+
+  def snapshot_status(self):
+    self.reap_snapshot()
+    return {"running": bool(self.snapshot_pid), "result": self.snapshot_result}
+
   # Print the contents of the hashtable
   def print_content(self):
     print self.data
@@ -94,32 +585,78 @@ class SimpleHT:
 
   # Remove expired entries
   def check(self):
-    now = datetime.now()
+    now = time.time()
     if self.next_check > now:
       return
-    self.next_check = datetime.now() + timedelta(minutes = 5)
+    self.next_check = now + CHECK_INTERVAL
+    self.reap_snapshot()
     to_remove = []
-    for key, value in self.data.items():
-      if value[1] < now:
+    for key, slot in self.slots.iteritems():
+      if self.expiry[slot] < now:
         to_remove.append(key)
     for key in to_remove:
-      del self.data[key]
+      self.remove(key)
+      self.index.discard(key)
   
   def list_contents(self):
-    c = self.data
-    d = c.keys()
+    d = self.data.keys()
+    if self.spill is not None:
+      d += self.spill.keys()
+    if self.base is not None:
+      d += [k for k in self.base.iter_from("") if k not in self.shadowed]
     print d
     return d
-    
+
+  # Up to limit keys starting with prefix, in order, after start_after.
+  # Page through a subtree by passing the last key returned as start_after
+  # while "more" is set.
+  def scan(self, prefix, start_after, limit):
+    self.check()
+    prefix = prefix.data
+    start_after = start_after.data
+    if start_after >= prefix:
+      keys = self.iter_keys(start_after, False)
+    else:
+      keys = self.iter_keys(prefix)
+    now = time.time()
+    rv = {"keys": [], "more": False}
+    for key in keys:
+      if not key.startswith(prefix):
+        break
+      # expired keys stay indexed until the next sweep, skip them
+      if key in self.slots:
+        if self.expiry[self.slots[key]] <= now:
+          continue
+      elif self.spill is None or key not in self.spill:
+        # neither in memory nor spilled, so it came from the mapped table
+        if self.base is None:
+          continue
+        found = self.base.find(key)
+        if found is None or found[2] <= now:
+          continue
+      if len(rv["keys"]) == limit:
+        rv["more"] = True
+        break
+      rv["keys"].append(Binary(key))
+    return rv
+
+  # Memory accounting, byte counts are doubles since XmlRpc ints are 32 bit
+  def stats(self):
+    return {"keys": len(self.data),
+            "spilled": len(self.spill) if self.spill is not None else 0,
+            "bytes": float(self.used_bytes),
+            "max_bytes": float(self.max_bytes),
+            "policy": self.policy,
+            "evictions": self.evictions}
   
   def corrupt(self,key):
     # Remove expired entries
     self.check()
     ttl = 6000
-    end = datetime.now() + timedelta(seconds = ttl)
+    end = time.time() + ttl
     pickled_val = pickle.dumps("This file is corrupted")
     value = Binary(pickled_val)
-    self.data[key.data] = (value.data, end)
+    self.store(key.data, value.data, end)
     return True
 
   def terminate(self):
@@ -129,36 +666,85 @@ class SimpleHT:
        
 
 def main():
-  #optlist, args = getopt.getopt(sys.argv[1:], "", ["port=", "test"])
   #server_handle = []
-  #print optlist," ",args
   print sys.argv
-  if len(sys.argv) < 2:
-    print 'usage: %s <data servers ports>' % sys.argv[0]
+  optlist, args = getopt.getopt(sys.argv[1:], "", ["bin-offset=", "max-bytes=",
+                                                   "policy=", "spill-dir=", "mmap-dir=",
+                                                   "workers=", "worker-offset="])
+  if len(args) < 1:
+    print 'usage: %s [--bin-offset=N] [--max-bytes=B] [--policy=lru|lfu|spill] ' \
+          '[--spill-dir=D] [--mmap-dir=D] [--workers=K] [--worker-offset=N] ' \
+          '<data servers ports>' % sys.argv[0]
     sys.exit(1)
-  ports = sys.argv[1:]
-  ports = map(int,ports)
-  spool = Pool(len(ports),init_worker)
+  ol = dict(optlist)
+  ports = map(int,args)
+  ht_opts = {"max_bytes": int(ol.get("--max-bytes", 0)),
+             "policy": ol.get("--policy", "lru"),
+             "spill_dir": ol.get("--spill-dir", "."),
+             "mmap_dir": ol.get("--mmap-dir")}
+  # with --bin-offset every server also speaks binproto on port + N
+  if "--bin-offset" in ol:
+    offset = int(ol["--bin-offset"])
+    servers = [(port, port + offset, ht_opts) for port in ports]
+  else:
+    servers = [(port, None, ht_opts) for port in ports]
+  # with --workers every server is K processes sharing its ports
+  workers = int(ol.get("--workers", 1))
+  if workers > 1:
+    worker_offset = int(ol.get("--worker-offset", 100))
+    servers = [(port, bin_port, dict(opts, workers = workers, worker = i,
+                                     worker_offset = worker_offset))
+               for port, bin_port, opts in servers for i in range(workers)]
+  spool = Pool(len(servers),init_worker)
   
-  spool.map(serve,ports)
+  spool.map(serve_pair,servers)
+
+def serve_pair(args):
+  port, bin_port, ht_opts = args
+  serve(port, bin_port, **ht_opts)
 
 # Start the xmlrpc server
-def serve(port):
+def serve(port, bin_port=None, max_bytes=0, policy="lru", spill_dir=".", mmap_dir=None,
+          workers=1, worker=0, worker_offset=100):
 
-  file_server = SimpleXMLRPCServer.SimpleXMLRPCServer(('', port))
+  if workers > 1:
+    file_server = ReusePortXMLRPCServer(('', port))
+    name = "%d-%d" % (port, worker)
+  else:
+    file_server = SimpleXMLRPCServer.SimpleXMLRPCServer(('', port))
+    name = "%d" % port
   file_server.register_introspection_functions()
-  sht = SimpleHT()
-  file_server.register_function(sht.get)
-  file_server.register_function(sht.put)
-  file_server.register_function(sht.print_content)
-  file_server.register_function(sht.read_file)
-  file_server.register_function(sht.write_file)
-  file_server.register_function(sht.terminate)
-  file_server.register_function(sht.list_contents)
-  file_server.register_function(sht.corrupt)
+  spill_path = None
+  if policy == "spill":
+    spill_path = os.path.join(spill_dir, "spill-%s.db" % name)
+  sht = SimpleHT(max_bytes, policy, spill_path)
+  # restart from <mmap_dir>/ht-<port>.map when there is one
+  if mmap_dir is not None:
+    map_path = os.path.join(mmap_dir, "ht-%s.map" % name)
+    if os.path.exists(map_path):
+      sht.open_mmap(Binary(map_path))
+      print "Mapped %d entries from %s" % (len(sht.base), map_path)
+  calls = sht
+  if workers > 1:
+    calls = Partition(sht, port, workers, worker, worker_offset)
+    calls.start()
+  for call in ("get", "put", "put_many", "print_content", "read_file", "write_file", "snapshot",
+               "snapshot_status", "write_mmap", "open_mmap", "terminate",
+               "list_contents", "stats", "scan", "corrupt"):
+    file_server.register_function(getattr(calls, call), call)
+  frame_server = None
+  if bin_port:
+    frame_server = binproto.FrameServer(calls, bin_port, workers > 1)
+    print "BINARY SERVER is UP at port: ",bin_port
   print "SERVER is UP at port: ",port
   while not sht.quit:
+    if frame_server is None:
       file_server.handle_request()
+    else:
+      for ready in frame_server.poll([file_server]):
+        ready.handle_request()
+  if frame_server is not None:
+    frame_server.close()
   file_server.server_close()
   del file_server
   print "SERVER is DOWN at port: ",port
@@ -166,8 +752,8 @@ def serve(port):
 
 # Execute the xmlrpc in a thread ... needed for testing
 class serve_thread:
-  def __call__(self, port):
-    serve(port)
+  def __call__(self, port, bin_port=None, **opts):
+    serve(port, bin_port, **opts)
 
 # Wrapper functions so the tests don't need to be concerned about Binary blobs
 class Helper:
@@ -211,6 +797,123 @@ class SimpleHTTest(unittest.TestCase):
     self.assertEqual(helper.get("some_other_key")["value"], "some_value", "Different keys")
     self.assertEqual(helper.get("test")["value"], "test2", "Verify contents")
 
+  def test_snapshot(self):
+    sht = SimpleHT()
+    helper = Helper(sht)
+    for i in range(3000):
+      helper.put("key%d" % i, "value%d" % i, 10000)
+    self.assertTrue(sht.snapshot(Binary("test")), "Snapshot didn't start")
+    # writes after the fork are not part of the snapshot
+    helper.put("key0", "changed", 10000)
+    while sht.snapshot_status()["running"]:
+      time.sleep(0.05)
+    self.assertEqual(sht.snapshot_status()["result"], "ok", "Snapshot failed")
+    helper = Helper(SimpleHT())
+    helper.read_file("test")
+    self.assertEqual(helper.get("key0")["value"], "value0", "Snapshot not isolated")
+    self.assertEqual(helper.get("key2999")["value"], "value2999", "Load unsuccessful!")
+    self.assertEqual(helper.caller.count(), 3000, "Lost entries")
+
+  def test_mmap(self):
+    sht = SimpleHT()
+    helper = Helper(sht)
+    for i in range(500):
+      helper.put("/d/%03d" % i, "value%d" % i, 10000)
+    helper.put("/gone", "value", 0)
+    sht.write_mmap(Binary("test"))
+    sht = SimpleHT()
+    helper = Helper(sht)
+    sht.open_mmap(Binary("test"))
+    self.assertEqual(sht.count(), 500, "Wrong mapped count")
+    self.assertEqual(helper.get("/d/123")["value"], "value123", "Mapped get failed")
+    self.assertEqual(helper.get("/gone"), {}, "Expired entry mapped")
+    self.assertEqual(helper.get("/missing"), {}, "Found a missing key")
+    # writes land in memory on top of the mapped table
+    helper.put("/d/123", "changed", 10000)
+    helper.put("/d/500", "new", 10000)
+    self.assertEqual(helper.get("/d/123")["value"], "changed", "Put didn't shadow mapped entry")
+    self.assertEqual(sht.count(), 501, "Wrong merged count")
+    rv = sht.scan(Binary("/d/"), Binary("/d/497"), 10)
+    self.assertEqual([k.data for k in rv["keys"]], ["/d/498", "/d/499", "/d/500"], "Bad merged scan")
+    rv = sht.scan(Binary("/d/12"), Binary(""), 100)
+    self.assertEqual(len(rv["keys"]), 10, "Shadowed key listed twice")
+    # and a remapped table holds the merged view
+    sht.write_mmap(Binary("test"))
+    sht.open_mmap(Binary("test"))
+    self.assertEqual(helper.get("/d/123")["value"], "changed", "Remap lost a write")
+    self.assertEqual(sht.count(), 501, "Wrong remapped count")
+
+  def test_legacy_file(self):
+    # tables written when entries were (value, datetime) tuples still load
+    f = open("test", "wb")
+    pickle.dump({"old": ("value", datetime.now() + timedelta(seconds = 10000))}, f)
+    f.close()
+    sht = SimpleHT()
+    helper = Helper(sht)
+    helper.read_file("test")
+    self.assertEqual(helper.get("old")["value"], "value", "Legacy load unsuccessful!")
+    self.assertTrue(helper.get("old")["ttl"] > 9000, "Legacy expiry lost")
+    # expired slots are handed out again
+    helper.put("short", "value", 0)
+    sht.count()
+    helper.put("other", "value", 10000)
+    self.assertEqual(len(sht.expiry), 2, "Slot not reused")
+
+  def test_scan(self):
+    sht = SimpleHT()
+    helper = Helper(sht)
+    keys = ["/a&&data", "/a/b&&data", "/a/c&&data", "/b&&data"]
+    keys += ["/d/%04d&&data" % i for i in range(3000)]
+    for key in reversed(keys):
+      helper.put(key, "v", 10000)
+    helper.put("/a/gone&&data", "v", 0)
+    def scan(prefix, after, limit):
+      rv = sht.scan(Binary(prefix), Binary(after), limit)
+      return [k.data for k in rv["keys"]], rv["more"]
+    self.assertEqual(scan("/a/", "", 10), (["/a/b&&data", "/a/c&&data"], False), "Bad prefix scan")
+    self.assertEqual(scan("/a/", "", 1), (["/a/b&&data"], True), "Bad limit")
+    self.assertEqual(scan("/a/", "/a/b&&data", 10), (["/a/c&&data"], False), "Bad page")
+    found, after, more = [], "", True
+    while more:
+      page, more = scan("/d/", after, 700)
+      found += page
+      after = page[-1] if page else after
+    self.assertEqual(found, sorted(keys[4:]), "Paging lost keys")
+    self.assertEqual(len(sht.index), len(keys) + 1, "Index out of step")
+    # evicted keys leave the index
+    sht = SimpleHT(max_bytes=100, policy="lru")
+    helper = Helper(sht)
+    for i in range(10):
+      helper.put("/k%d" % i, "v" * 26, 10000)
+    self.assertEqual(scan("/", "", 100), (["/k7", "/k8", "/k9"], False), "Scan returned evicted keys")
+    self.assertEqual(len(sht.index), 3, "Evicted keys left in the index")
+
+  def test_memory_cap(self):
+    for policy in ("lru", "lfu"):
+      sht = SimpleHT(max_bytes=100, policy=policy)
+      helper = Helper(sht)
+      helper.put("hot", "h" * 27, 10000)
+      for i in range(5):
+        helper.get("hot")
+      for i in range(10):
+        helper.put("key%d" % i, "v" * 26, 10000)
+        helper.get("hot")
+      self.assertTrue(sht.used_bytes <= 100, "Cap not enforced with %s" % policy)
+      self.assertEqual(sht.stats()["bytes"], sht.used_bytes, "Bad accounting")
+      self.assertEqual(helper.get("hot")["value"], "h" * 27, "Evicted hot key with %s" % policy)
+      self.assertEqual(helper.get("key0"), {}, "Cold key survived with %s" % policy)
+      self.assertEqual(helper.get("key9")["value"], "v" * 26, "Evicted newest key")
+    sht = SimpleHT(max_bytes=100, policy="spill", spill_path="test-spill")
+    helper = Helper(sht)
+    for i in range(10):
+      helper.put("key%d" % i, "v" * 26, 10000)
+    self.assertTrue(sht.stats()["spilled"] > 0, "Nothing spilled")
+    self.assertEqual(helper.get("key0")["value"], "v" * 26, "Lost a spilled key")
+    self.assertEqual(sht.count(), 10, "Spilled keys not counted")
+    sht.spill.close()
+    for name in glob.glob("test-spill*"):
+      os.remove(name)
+
   # Test via RPC
   def test_xmlrpc(self):
     output_thread = threading.Thread(target=serve_thread(), args=(51234, ))
@@ -231,5 +934,82 @@ class SimpleHTTest(unittest.TestCase):
     self.assertTrue(helper.put("test", "test2", 20000))
     self.assertEqual(helper.get("test")["value"], "test2", "Store new value")
 
+  # Test via the framed binary transport
+  def test_binary(self):
+    output_thread = threading.Thread(target=serve_thread(), args=(51244, 51245))
+    output_thread.setDaemon(True)
+    output_thread.start()
+
+    time.sleep(1)
+    helper = Helper(binproto.FrameProxy("bin://127.0.0.1:51245"))
+    self.assertEqual(helper.get("test"), {}, "DHT isn't empty")
+    self.assertTrue(helper.put("test", "test", 10000), "Failed to put")
+    self.assertEqual(helper.get("test")["value"], "test", "Failed to perform single get")
+    big = "x" * (binproto.COALESCE_LIMIT * 3)
+    self.assertTrue(helper.put("big", big, 10000), "Failed to put")
+    self.assertEqual(helper.get("big")["value"].data, big, "Failed to get large value")
+    # both endpoints serve the same table
+    rpc = Helper(xmlrpclib.Server("http://127.0.0.1:51244"))
+    self.assertEqual(rpc.get("test")["value"], "test", "Endpoints disagree")
+
+  # Many requests in flight on one connection, replies matched by id
+  def test_pipelined(self):
+    output_thread = threading.Thread(target=serve_thread(), args=(51246, 51247))
+    output_thread.setDaemon(True)
+    output_thread.start()
+
+    time.sleep(1)
+    proxy = binproto.FrameProxy("bin://127.0.0.1:51247")
+    items = [(Binary("key%d" % i), Binary("value%d" % i)) for i in range(200)]
+    self.assertEqual(proxy.put_many(items, 10000), [True] * 200, "Failed pipelined put")
+    rvs = proxy.get_many([key for key, value in items])
+    self.assertEqual([rv["value"].data for rv in rvs], ["value%d" % i for i in range(200)],
+                     "Replies matched to the wrong requests")
+    results = []
+    def worker(n):
+      results.append(proxy.get(Binary("key%d" % n))["value"].data == "value%d" % n)
+    threads = [threading.Thread(target=worker, args=(n, )) for n in range(20)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(results, [True] * 20, "Concurrent callers got the wrong replies")
+
+  # A request that times out is not left pending on the connection
+  def test_timeout(self):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("127.0.0.1", 51248))
+    listener.listen(1)
+    proxy = binproto.FrameProxy("bin://127.0.0.1:51248", timeout=0.2)
+    self.assertRaises(socket.timeout, proxy.get, Binary("key"))
+    self.assertRaises(socket.timeout, proxy.put, Binary("key"), Binary("value"), 10)
+    self.assertEqual(proxy.conn.pending, {}, "Timed out requests left pending")
+    listener.close()
+
+  def test_workers(self):
+    for i in range(2):
+      output_thread = threading.Thread(target=serve_thread(), args=(51260, 51261),
+                                       kwargs={"workers": 2, "worker": i, "worker_offset": 10})
+      output_thread.setDaemon(True)
+      output_thread.start()
+    time.sleep(1)
+    helper = Helper(xmlrpclib.Server("http://127.0.0.1:51260"))
+    keys = ["/w/key%02d" % i for i in range(40)]
+    for key in keys:
+      self.assertTrue(helper.put(key, key + "-value", 10000))
+    frames = Helper(binproto.FrameProxy("bin://127.0.0.1:51261"))
+    for key in keys:
+      self.assertEqual(helper.get(key)["value"], key + "-value", "Lost a forwarded put")
+      self.assertEqual(frames.get(key)["value"], key + "-value", "Lost a forwarded get")
+    rv = helper.caller.scan(Binary("/w/"), Binary(""), 30)
+    self.assertEqual([key.data for key in rv["keys"]], keys[:30], "Bad merged scan")
+    self.assertTrue(rv["more"])
+    # each worker only holds its own partition
+    owned = [xmlrpclib.Server("http://127.0.0.1:%d" % port).scan(Binary("/w/"), Binary(""), 100)
+             for port in (51270, 51272)]
+    self.assertTrue(all(rv["keys"] for rv in owned), "Keys not partitioned")
+    self.assertEqual(sum(len(rv["keys"]) for rv in owned), 40)
+
 if __name__ == "__main__":
   main()
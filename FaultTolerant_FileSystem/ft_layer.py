@@ -1,29 +1,248 @@
 #!/usr/bin/env python
 import logging
-from collections import defaultdict
-from errno import ENOENT
+from collections import defaultdict, OrderedDict
+from errno import ENOENT, EAGAIN
 from stat import S_IFDIR, S_IFLNK, S_IFREG
 from sys import argv, exit
 from time import time,sleep
 import datetime
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 from xmlrpclib import Binary
-import sys, pickle, xmlrpclib
-import signal
+import sys, pickle, xmlrpclib, unittest
+import signal, socket, random, threading, functools, SimpleXMLRPCServer
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 import hashlib
+import binproto
+import blobcodec
 
 QR =1
 QW =1
 ping_time=0.1
+# compression level for stored values, 0 stores them uncompressed
+COMPRESS_LEVEL = blobcodec.DEFAULT_LEVEL
+# how many of the leading urls are meta server shards
+META_SHARDS = 1
+
+def server_proxy(url):
+    # bin:// urls use the framed socket transport, anything else XmlRpc
+    if url.startswith(binproto.SCHEME):
+        return binproto.FrameProxy(url)
+    return xmlrpclib.Server(url)
+
+# A replicated meta server is given as a comma separated group of XmlRpc
+# urls, primary first.  The primary each group was last found at and when
+# this process last wrote to it are remembered across proxies.
+_meta_primary = {}
+_meta_wrote = {}
+# gets stay on the primary this long after our own put, so a read-modify-
+# write never starts from a backup that has not seen the previous write
+META_STICKY = 2.0
+META_ERRORS = (socket.error, xmlrpclib.ProtocolError, xmlrpclib.Fault)
+
+def meta_proxy(meta_url):
+    if "," in meta_url:
+        return MetaGroup(meta_url)
+    return server_proxy(meta_url)
+
+class MetaGroup:
+    # get / put on a replicated meta server.  Puts go to the primary, gets
+    # to a random backup and on to the primary when that backup is down or
+    # too stale to answer.  When the primary cannot be reached the replica
+    # that has applied the most of its log is promoted in its place.
+    def __init__(self,meta_url):
+        self.group = meta_url
+        self.urls = meta_url.split(",")
+
+    def primary(self):
+        return _meta_primary.get(self.group,0)
+
+    def failover(self):
+        best = None
+        for i,url in enumerate(self.urls):
+            try:
+                st = xmlrpclib.Server(url).status()
+            except META_ERRORS:
+                continue
+            if st["role"] == "primary":
+                _meta_primary[self.group] = i
+                return
+            if best is None or (st["epoch"],st["seq"]) > best[0]:
+                best = ((st["epoch"],st["seq"]),i)
+        if best is None:
+            sleep(ping_time)
+            return
+        print "Promoting meta server",self.urls[best[1]]
+        try:
+            xmlrpclib.Server(self.urls[best[1]]).promote()
+            _meta_primary[self.group] = best[1]
+        except META_ERRORS:
+            sleep(ping_time)
+
+    def call(self,op,*args):
+        for attempt in range(2*len(self.urls)):
+            try:
+                return getattr(server_proxy(self.urls[self.primary()]),op)(*args)
+            except META_ERRORS:
+                self.failover()
+        raise socket.error("no primary in meta server group %s" % self.group)
+
+    def put(self,key,value,ttl,*client):
+        rv = self.call("put",key,value,ttl,*client)
+        _meta_wrote[self.group] = time()
+        return rv
+
+    def put_many(self,items,ttl,*client):
+        rv = self.call("put_many",items,ttl,*client)
+        _meta_wrote[self.group] = time()
+        return rv
+
+    def txn(self,checks,puts,ttl,*client):
+        # marks a write even when it fails, so the retry reads the primary
+        rv = self.call("txn",checks,puts,ttl,*client)
+        _meta_wrote[self.group] = time()
+        return rv
+
+    def get(self,key,*client):
+        # only the primary grants leases
+        if client:
+            return self.call("get",key,*client)
+        backups = [i for i in range(len(self.urls)) if i != self.primary()]
+        if backups and time() - _meta_wrote.get(self.group,0) > META_STICKY:
+            try:
+                return server_proxy(self.urls[random.choice(backups)]).get(key)
+            except META_ERRORS:
+                pass
+        return self.call("get",key)
+
+def meta_shard(meta_urls,path):
+    # the meta server that owns path: its meta, its list_nodes and the
+    # checksums of its data all live on the same shard
+    if len(meta_urls) == 1:
+        return meta_urls[0]
+    return meta_urls[int(hashlib.md5(path).hexdigest()[:8],16) % len(meta_urls)]
+
+# The writes of one FS operation.  While a batch is open on this thread
+# reliable_put only records the value and reliable_get answers from it, so
+# an operation sees its own writes and fetches each key at most once;
+# closing the batch sends every write with one put_many per server.  It
+# lives in a threading.local rather than on the FileNodes, which are pickled.
+_local = threading.local()
+
+#
+# Meta keys a batch read and then wrote are committed with a txn that
+# checks they are still at the version read, so concurrent mounts changing
+# the same directory cannot lose each other's updates.  On a conflict the
+# whole operation is run again from fresh reads.
+class Conflict(Exception):
+    pass
+
+TXN_RETRIES = 10
+
+class Batch:
+    def __init__(self):
+        self.layer = None
+        self.writes = OrderedDict()
+        self.reads = {}
+        self.versions = {}
+        # pickled meta values as read, to undo a half committed flush
+        self.originals = {}
+
+    def flush(self):
+        if self.writes:
+            self.layer.reliable_put_many([(path,key,value) for (path,key),value in self.writes.items()],
+                                         self.versions,self.originals)
+
+def current_batch():
+    return getattr(_local,"batch",None)
+
+def batched(fn):
+    # run fn as one batch, calls made inside it join the same batch; if fn
+    # raises none of its writes are sent, if the commit conflicts fn is
+    # run again
+    @functools.wraps(fn)
+    def call(*args,**kwargs):
+        if current_batch() is not None:
+            return fn(*args,**kwargs)
+        for attempt in range(TXN_RETRIES):
+            batch = _local.batch = Batch()
+            try:
+                rv = fn(*args,**kwargs)
+            finally:
+                _local.batch = None
+            try:
+                batch.flush()
+                return rv
+            except Conflict:
+                sleep(random.random()*ping_time*(attempt+1))
+        print fn.__name__,"kept conflicting, giving up"
+        raise FuseOSError(EAGAIN)
+    return call
+
+# Client read leases, off until enable_leases() is called.  meta and
+# list_nodes values read from a primary are cached until the lease runs out
+# or the metaserver calls invalidate() on our callback server, which it
+# does before acknowledging another client's write.  File data is cached
+# under the lease of its checksum key, which every data write changes.
+# Values are kept pickled so callers can modify what they are handed.
+LEASE_MARGIN = 0.5
+_lease_url = ""
+_lease_lock = threading.Lock()
+_lease_cache = {}
+_lease_gen = [0]
+
+def enable_leases(host="127.0.0.1",port=0):
+    global _lease_url
+    server = SimpleXMLRPCServer.SimpleXMLRPCServer((host,port),logRequests=False)
+    server.register_function(invalidate)
+    callbacks = threading.Thread(target=server.serve_forever)
+    callbacks.setDaemon(True)
+    callbacks.start()
+    _lease_url = "http://%s:%d" % (host,server.server_address[1])
+    return _lease_url
+
+def invalidate(keys):
+    with _lease_lock:
+        _lease_gen[0] += 1
+        for key in keys:
+            _lease_cache.pop(key.data,None)
+    return True
+
+def lease_client(meta_url):
+    # extra argument for gets and writes on meta_url: our callback url when
+    # leases are on, never over the binary transport
+    if _lease_url and not meta_url.startswith(binproto.SCHEME):
+        return (_lease_url,)
+    return ()
+
+def lease_lookup(key):
+    # (pickled value, version) while the lease on key holds, else None
+    with _lease_lock:
+        hit = _lease_cache.get(key)
+        if hit is None or hit[2] < time():
+            return None
+        return hit[:2]
+
+def lease_store(key,pickled,version,lease,gen):
+    # gen is _lease_gen from before the get; if anything was invalidated
+    # since, the reply may already be stale and is not cached
+    with _lease_lock:
+        if _lease_gen[0] == gen:
+            _lease_cache[key] = (pickled,version,time()+lease-LEASE_MARGIN)
+
+def lease_forget(keys):
+    # our own writes are not called back, drop them here
+    with _lease_lock:
+        for key in keys:
+            _lease_cache.pop(key,None)
+
 def put_fault_handler(fservers,path,key,value):
     #handle failed puts
     print "Put fault handler is handling...."
     count = len(fservers)-1
     while count > -1:
         try:
-            if fservers[count].put(Binary(key),Binary(pickle.dumps(value)),6000) == True:
+            if fservers[count].put(Binary(key),Binary(blobcodec.encode(pickle.dumps(value),COMPRESS_LEVEL)),6000) == True:
                 fservers.pop(count)
                 count = count -1
         except:
@@ -37,14 +256,15 @@ def update_checksum(meta_url,path,key,pickled_value):
  
     dat_checksum = hashlib.md5(pickled_value).hexdigest()
     #put checksum on the meta server\
-    meta_server  = xmlrpclib.Server(meta_url)
-    meta_server.put(Binary(key),Binary(dat_checksum),6000)
+    meta_server  = meta_proxy(meta_url)
+    meta_server.put(Binary(key),Binary(dat_checksum),6000,*lease_client(meta_url))
+    lease_forget([key])
 
 
 def validate_checksum(meta_url,data_servers,path,key,rdata):
     fkey = path + key+"&&checksum"
     key = path + "&&" + key
-    meta_server  = xmlrpclib.Server(meta_url)
+    meta_server  = meta_proxy(meta_url)
     valid_checksum = meta_server.get(Binary(fkey))
     print valid_checksum, path, fkey
     valid_checksum = valid_checksum["value"].data
@@ -88,19 +308,24 @@ def validate_checksum(meta_url,data_servers,path,key,rdata):
     if isCorrupted:
         #correct the data on each of the corrupted servers  
         for fs_id in failed_server_ids:
-            dh = xmlrpclib.Server(data_servers[fs_id])
+            dh = server_proxy(data_servers[fs_id])
             try:
                 dh.put(Binary(key),Binary(good_data),6000)
             except:
                 print "Server Down"
             
-    return  pickle.loads(good_data)
+    return  pickle.loads(blobcodec.decode(good_data))
 
 class ReliableLayer:
-    def __init__(self,qr,qw,urls):        
+    # the first meta_shards urls (META_SHARDS by default) are meta servers,
+    # each owning the paths that hash to it, the rest are data servers
+    def __init__(self,qr,qw,urls,meta_shards=None):
+        if meta_shards is None:
+            meta_shards = META_SHARDS
         self.urls = urls        
-        self.meta_url = urls[0]
-        self.data_urls = urls[1:]
+        self.meta_urls = urls[:meta_shards]
+        self.meta_url = self.meta_urls[0]
+        self.data_urls = urls[meta_shards:]
         global QR
         global QW
         QR=qr
@@ -110,7 +335,7 @@ class ReliableLayer:
 
         # getting meta server handlers
         try:
-          self.meta_hdl = xmlrpclib.Server(self.meta_url)
+          self.meta_hdl = meta_proxy(self.meta_url)
         except:
           print "couldn't connect to meta server"
         # setting up data server handlers
@@ -119,13 +344,21 @@ class ReliableLayer:
 
 
     def reliable_put(self,path,key,value):
-        pickled_value = pickle.dumps(value)
+        batch = current_batch()
+        if batch is not None:
+            batch.layer = self
+            batch.writes[(path,key)] = value
+            return
+        # checksums are taken over the stored (possibly compressed) bytes
+        pickled_value = blobcodec.encode(pickle.dumps(value),COMPRESS_LEVEL)
         if key == "meta" or key == "list_nodes":
             key = path +"&&" + key
-            self.meta_hdl = xmlrpclib.Server(self.meta_url)
-            self.meta_hdl.put(Binary(key),Binary(pickled_value),6000)
+            shard = meta_shard(self.meta_urls,path)
+            self.meta_hdl = meta_proxy(shard)
+            self.meta_hdl.put(Binary(key),Binary(pickled_value),6000,*lease_client(shard))
+            lease_forget([key])
         else:           
-            update_checksum(self.meta_url,path,key,pickled_value)
+            update_checksum(meta_shard(self.meta_urls,path),path,key,pickled_value)
             count = 0
             #contains handlers for failed puts
             failed_server_ids = []
@@ -142,7 +375,7 @@ class ReliableLayer:
                     no_tries = no_tries+1
                     try:
                         # try to connect to the server
-                        dh = xmlrpclib.Server(url)
+                        dh = server_proxy(url)
                         dh.put(Binary(key),Binary(pickled_value),6000)
                         isConnected = True
                         live_server_ids.append(server_id)
@@ -159,20 +392,132 @@ class ReliableLayer:
             if len(live_server_ids) < QW:
                 print "Failed to put in the ",live_server_ids ," servers"
                 
-    def reliable_get(self,path,key):    
+    # items of (path, key, value) in one put_many per server: meta keys and
+    # data checksums to their meta shard, data to every data server.  Meta
+    # keys with a version in versions go in a txn checking that version;
+    # raises Conflict if one changed.  A create, link, delete or rename
+    # usually checks two shards, the node's and its parent's.  Checked
+    # shards are committed first, in url order.  When a later one
+    # conflicts, the checked keys already committed are put back to their
+    # pickled values in originals, as the batch read them, unless someone
+    # has written them since, so the op is undone before it is run again.
+    # Unchecked keys written alongside them, like a new node's list_nodes
+    # or a data checksum, are left, as is anything another client saw in
+    # between.
+    def reliable_put_many(self,items,versions={},originals={}):
+        meta_items = defaultdict(list)
+        checks = defaultdict(list)
+        data_items = []
+        for path,key,value in items:
+            pickled_value = blobcodec.encode(pickle.dumps(value),COMPRESS_LEVEL)
+            shard = meta_shard(self.meta_urls,path)
+            if key == "meta" or key == "list_nodes":
+                meta_items[shard].append((Binary(path+"&&"+key),Binary(pickled_value)))
+                if versions.get((path,key)) is not None:
+                    checks[shard].append((Binary(path+"&&"+key),versions[(path,key)]))
+            else:
+                dat_checksum = hashlib.md5(pickled_value).hexdigest()
+                meta_items[shard].append((Binary(path+key+"&&checksum"),Binary(dat_checksum)))
+                data_items.append((Binary(path+"&&"+key),Binary(pickled_value)))
+        committed = []
+        for shard in sorted(meta_items,key=lambda shard: (shard not in checks,shard)):
+            # whatever happens to the write, our cached copies are out of date
+            lease_forget([key.data for key,value in meta_items[shard]])
+            if shard in checks:
+                rv = meta_proxy(shard).txn(checks[shard],meta_items[shard],6000,*lease_client(shard))
+                if not rv["ok"]:
+                    for done,written in committed:
+                        self.undo(done,written,originals)
+                    raise Conflict(shard)
+                committed.append((shard,zip([key for key,version in checks[shard]],rv["versions"])))
+            else:
+                meta_proxy(shard).put_many(meta_items[shard],6000,*lease_client(shard))
+        if not data_items:
+            return
+        global QW
+        live_servers = 0
+        for url in self.data_urls:
+            for no_tries in range(5):
+                try:
+                    server_proxy(url).put_many(data_items,6000)
+                    live_servers = live_servers + 1
+                    break
+                except:
+                    sleep(ping_time)
+                    print "Trying to reconnect to the server",url
+        if live_servers < QW:
+            print "Failed to put in ",QW," servers"
+
+    # Put the checked keys of a committed shard back as they were read,
+    # provided they are still at the version we wrote.  A key that did not
+    # exist is put back with no time to live, which reads as absent.
+    def undo(self,shard,written,originals):
+        for ttl in (6000,0):
+            checks = []
+            puts = []
+            for key,version in written:
+                path,field = key.data.rsplit("&&",1)
+                pickled = originals.get((path,field))
+                if (pickled is None) != (ttl == 0):
+                    continue
+                checks.append((key,version))
+                puts.append((key,Binary(blobcodec.encode(pickled or pickle.dumps(None),COMPRESS_LEVEL))))
+            if checks:
+                lease_forget([key.data for key,version in checks])
+                if not meta_proxy(shard).txn(checks,puts,ttl,*lease_client(shard))["ok"]:
+                    print "Could not undo the write to",shard,"it has changed since"
+
+    def reliable_get(self,path,key):
+        batch = current_batch()
+        if batch is None:
+            return self.fetch(path,key)
+        if (path,key) in batch.writes:
+            return batch.writes[(path,key)]
+        if (path,key) not in batch.reads:
+            batch.reads[(path,key)] = self.fetch(path,key)
+        return batch.reads[(path,key)]
+
+    def fetch(self,path,key):    
         
         if key == "meta" or key == "list_nodes":
             key = path+"&&"+key
-            self.meta_hdl = xmlrpclib.Server(self.meta_url)
-            res = self.meta_hdl.get(Binary(key))
-            if "value" in res:
-                return pickle.loads(res["value"].data)
+            shard = meta_shard(self.meta_urls,path)
+            client = lease_client(shard)
+            hit = lease_lookup(key) if client else None
+            if hit is not None:
+                pickled,version = hit
+            else:
+                gen = _lease_gen[0]
+                self.meta_hdl = meta_proxy(shard)
+                res = self.meta_hdl.get(Binary(key),*client)
+                pickled = blobcodec.decode(res["value"].data) if "value" in res else None
+                version = res.get("version",0)
+                if "lease" in res:
+                    lease_store(key,pickled,version,res["lease"],gen)
+            # remember the version a batch read so its commit can check it;
+            # the binary transport does not carry versions
+            batch = current_batch()
+            if batch is not None and not shard.startswith(binproto.SCHEME):
+                batch.versions[(path,key[len(path)+2:])] = version
+                batch.originals[(path,key[len(path)+2:])] = pickled
+            if pickled is not None:
+                return pickle.loads(pickled)
             else:
                 return None
 
         else:
             tkey = key
             key = path +"&&" + key
+            # data is cached under a lease on its checksum key
+            shard = meta_shard(self.meta_urls,path)
+            client = lease_client(shard)
+            if client:
+                ckey = path+tkey+"&&checksum"
+                hit = lease_lookup(ckey)
+                if hit is not None:
+                    return pickle.loads(hit[0])
+                gen = _lease_gen[0]
+                lease = meta_proxy(shard).get(Binary(ckey),*client).get("lease")
             
             #Append data recieved from server to rdata
             rdata = []
@@ -186,7 +531,7 @@ class ReliableLayer:
                 while isConnected == False and no_tries < 5:
                     try:
                         # try to connect to the server
-                        dh = xmlrpclib.Server(url)
+                        dh = server_proxy(url)
                         res = dh.get(Binary(key))
                         g_count = g_count+1
                         # append to rdata
@@ -210,7 +555,57 @@ class ReliableLayer:
                 return None
 
             # validate checksum
-            result  =validate_checksum(self.meta_url,self.data_urls,path,tkey,rdata)
+            result  =validate_checksum(shard,self.data_urls,path,tkey,rdata)
+            if client and lease and result != []:
+                lease_store(ckey,pickle.dumps(result,2),0,lease,gen)
 
             return result
            
+
+
+# python -m unittest ft_layer, with two meta server shards in threads
+class ReliableLayerTest(unittest.TestCase):
+    def test_cross_shard_conflict(self):
+        import metaserver
+        urls = ["http://127.0.0.1:%d" % port for port in (51290,51291)]
+        for port in (51290,51291):
+            server = threading.Thread(target=metaserver.serve_thread(),args=(port,))
+            server.setDaemon(True)
+            server.start()
+        sleep(1)
+        layer = ReliableLayer(1,1,urls,2)
+        # the parent's shard commits after the new node's
+        parent = [p for p in ("/d%d" % i for i in range(100)) if meta_shard(urls,p) == urls[1]][0]
+        child = [p for p in (parent+"/f%d" % i for i in range(100)) if meta_shard(urls,p) == urls[0]][0]
+        layer.reliable_put(parent,"list_nodes",{})
+        def version(path,key):
+            return xmlrpclib.Server(meta_shard(urls,path)).get(Binary(path+"&&"+key)).get("version",0)
+        stale = version(parent,"list_nodes")
+        layer.reliable_put(parent,"list_nodes",{"other":"/other"})
+        # a create that read the parent before the write above
+        items = [(child,"meta",{"st_nlink":1}),(parent,"list_nodes",{"f":child})]
+        versions = {(child,"meta"):0,(parent,"list_nodes"):stale}
+        originals = {(child,"meta"):None,(parent,"list_nodes"):pickle.dumps({})}
+        self.assertRaises(Conflict,layer.reliable_put_many,items,versions,originals)
+        self.assertEqual(layer.fetch(child,"meta"),None,"New node's meta left without a parent entry")
+        self.assertEqual(version(child,"meta"),0)
+        self.assertEqual(layer.fetch(parent,"list_nodes"),{"other":"/other"})
+        # run through a batch the create is retried and lands whole
+        raced = []
+        @batched
+        def create():
+            if layer.reliable_get(child,"meta") is None:
+                layer.reliable_put(child,"meta",{"st_nlink":1})
+            names = layer.reliable_get(parent,"list_nodes")
+            names[child.split("/")[-1]] = child
+            layer.reliable_put(parent,"list_nodes",names)
+            if not raced:
+                raced.append(True)
+                xmlrpclib.Server(urls[1]).put(Binary(parent+"&&list_nodes"),
+                                              Binary(pickle.dumps({"other":"/other","late":"/late"})),6000)
+        create()
+        self.assertEqual(layer.fetch(child,"meta"),{"st_nlink":1})
+        self.assertEqual(sorted(layer.fetch(parent,"list_nodes")),sorted(["late","other",child.split("/")[-1]]),
+                         "Retried create lost an entry")
+        for url in urls:
+            xmlrpclib.Server(url).terminate()
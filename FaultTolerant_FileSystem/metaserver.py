@@ -5,42 +5,276 @@ Version: 0.02
 
 Description:
 The XmlRpc API for this library is:
-  get(base64 key)
-    Returns the value and ttl associated with the given key using a dictionary
-      or an empty dictionary if there is no matching key
+  get(base64 key[, string client])
+    Returns the value, ttl and version associated with the given key using a
+      dictionary or an empty dictionary if there is no matching key.  With a
+      client callback url the primary also grants a read lease, "lease" in
+      the reply being its length in seconds: until then the client is sent
+      invalidate([base64 key]) before any other client's write of the key
+      is acknowledged
     Example usage:
       rv = rpc.get(Binary("key"))
       print rv => {"value": Binary, "ttl": 1000}
       print rv["value"].data => "value"
-  put(base64 key, base64 value, int ttl)
+  put(base64 key, base64 value, int ttl[, string client])
     Inserts the key / value pair into the hashtable, using the same key will
       over-write existing values
     Example usage:  rpc.put(Binary("key"), Binary("value"), 1000)
+  put_many(list items, int ttl[, string client])
+    put of every [base64 key, base64 value] pair in items, in one request;
+      returns a list of True
+  cas(base64 key, int version, base64 value, int ttl)
+    put only if the key is still at version (0 for absent); returns
+      {"ok": bool, "version": int}
+  txn(list checks, list puts, int ttl[, string client])
+    put every [base64 key, base64 value] of puts only if every
+      [base64 key, int version] of checks holds, all or nothing; returns
+      {"ok": bool, "versions": [int, ...]}
+    The client of put, put_many and txn is the writer's callback url, its
+      own leases are dropped without a callback
   print_content()
     Print the contents of the HT
   read_file(string filename)
     Store the contents of the Hahelperable into a file
   write_file(string filename)
     Load the contents of the file into the Hahelperable
+  checkpoint()
+    With a write-ahead log, save the table beside the log and empty it
+  promote()
+    Make a backup the primary of its replica group
+  status()
+    Returns the role, epoch, last applied seq and staleness in seconds
+  apply_log(int epoch, int first_seq, base64 records, int head)
+  install_snapshot(int epoch, int seq, base64 table)
+    Used between the primary and its backups
+
+The get and put calls are also served over the framed socket transport in
+binproto.py when the server is started with a binary port.
 """
 
 import sys, SimpleXMLRPCServer, getopt, pickle, time, threading, xmlrpclib, unittest
 from datetime import datetime, timedelta
 from xmlrpclib import Binary
 from multiprocessing import Pool
-import signal
+import signal, os, struct, zlib, socket, SocketServer
+from collections import deque
+from itertools import islice
+import binproto
 
 quit = 0
 
+LOG_HDR = struct.Struct("!II")
+
+# Fault codes of a backup refusing a request
+NOT_PRIMARY = 1
+STALE = 2
+# Replication: seconds between heartbeats, mutations kept for backups
+# that fall behind, and the most mutations sent in one shipment
+HEARTBEAT = 0.5
+BACKLOG_SIZE = 100000
+SHIP_BATCH = 1000
+# Seconds a client may cache a key it read with get(key, client), and how
+# long to wait on a lease holder's invalidate callback
+LEASE_TERM = 5.0
+CALLBACK_TIMEOUT = 1.0
+
 def init_worker():
   signal.signal(signal.SIGINT, signal.SIG_IGN)
 
+# Append-only log of mutations with group commit.  append() buffers a
+# record and hands back its log sequence number; a flusher thread waits
+# window seconds so that concurrent puts can join the group, then writes
+# and fsyncs everything buffered at once.  wait(lsn) blocks until that
+# record is on disk.
+#
+# Each record is LOG_HDR (length, crc32) followed by a pickled tuple.
+class WriteAheadLog:
+  def __init__(self, path, window=0.002):
+    self.path = path
+    self.window = window
+    self.f = None
+    self.cond = threading.Condition()
+    self.buffer = []
+    self.next_lsn = 0
+    self.durable_lsn = 0
+    self.syncs = 0
+    self.valid_size = 0
+
+  # Records from an earlier run, stopping at a torn or corrupt tail
+  def replay(self):
+    self.valid_size = 0
+    if not os.path.exists(self.path):
+      return
+    f = open(self.path, "rb")
+    while True:
+      header = f.read(LOG_HDR.size)
+      if len(header) < LOG_HDR.size:
+        break
+      size, crc = LOG_HDR.unpack(header)
+      data = f.read(size)
+      if len(data) < size or zlib.crc32(data) & 0xffffffff != crc:
+        break
+      self.valid_size += LOG_HDR.size + size
+      yield pickle.loads(data)
+    f.close()
+
+  # Open for appending after replay, cutting off any torn tail
+  def start(self):
+    self.f = open(self.path, "ab")
+    self.f.truncate(self.valid_size)
+    flusher = threading.Thread(target=self.flush_loop)
+    flusher.setDaemon(True)
+    flusher.start()
+
+  def append(self, record):
+    data = pickle.dumps(record, 2)
+    frame = LOG_HDR.pack(len(data), zlib.crc32(data) & 0xffffffff) + data
+    with self.cond:
+      self.buffer.append(frame)
+      self.next_lsn += 1
+      self.cond.notify_all()
+      return self.next_lsn
+
+  def wait(self, lsn):
+    with self.cond:
+      while self.durable_lsn < lsn:
+        self.cond.wait()
+
+  def flush_loop(self):
+    while True:
+      with self.cond:
+        while not self.buffer:
+          self.cond.wait()
+      # let more commits join this group
+      time.sleep(self.window)
+      with self.cond:
+        frames, self.buffer = self.buffer, []
+        lsn = self.next_lsn
+      self.f.write("".join(frames))
+      self.f.flush()
+      os.fsync(self.f.fileno())
+      with self.cond:
+        self.durable_lsn = lsn
+        self.syncs += 1
+        self.cond.notify_all()
+
+  # Empty the log once its records are covered by a checkpoint.  The
+  # caller must keep new records from being appended meanwhile.
+  def truncate(self):
+    self.wait(self.next_lsn)
+    with self.cond:
+      self.f.truncate(0)
+      self.f.flush()
+      os.fsync(self.f.fileno())
+
+
+# XmlRpc transport that gives up on a lease holder after CALLBACK_TIMEOUT
+class CallbackTransport(xmlrpclib.Transport):
+  def make_connection(self, host):
+    conn = xmlrpclib.Transport.make_connection(self, host)
+    conn.timeout = CALLBACK_TIMEOUT
+    return conn
+
+# Ships the primary's mutations to one backup, in order.  Each shipment
+# is apply_log(epoch, first seq, records, head), head being the primary's
+# seq when the records were taken; the reply carries the backup's last
+# applied seq, which is where the next shipment starts.  An empty
+# shipment is sent every HEARTBEAT seconds so backups can tell how stale
+# they are, and a backup only counts itself fresh once it reaches head.
+# A backup that needs records no longer in the backlog is sent the whole
+# table with install_snapshot.
+class LogShipper:
+  def __init__(self, sht, url):
+    self.sht = sht
+    self.url = url
+    self.running = True
+
+  def start(self):
+    shipper = threading.Thread(target=self.run)
+    shipper.setDaemon(True)
+    shipper.start()
+
+  def run(self):
+    proxy = xmlrpclib.Server(self.url)
+    next_seq = None
+    while self.running:
+      try:
+        if next_seq is None:
+          rv = proxy.apply_log(self.sht.epoch, 0, Binary(pickle.dumps([], 2)), self.sht.seq)
+        else:
+          batch = self.sht.backlog_from(next_seq, HEARTBEAT)
+          if not self.running:
+            break
+          if batch is None:
+            with self.sht.lock:
+              blob = pickle.dumps(self.sht.state(), 2)
+              seq = self.sht.seq
+            rv = proxy.install_snapshot(self.sht.epoch, seq, Binary(blob))
+          else:
+            records, head = batch
+            rv = proxy.apply_log(self.sht.epoch, next_seq, Binary(pickle.dumps(records, 2)), head)
+      except (socket.error, xmlrpclib.ProtocolError, xmlrpclib.Fault):
+        # down or restarting, find out where it stands once it is back
+        next_seq = None
+        time.sleep(HEARTBEAT)
+        continue
+      if rv["epoch"] > self.sht.epoch:
+        self.sht.step_down(rv["epoch"])
+        break
+      if rv["role"] == "primary":
+        print "Peer %s is also primary in epoch %d" % (self.url, rv["epoch"])
+        time.sleep(HEARTBEAT)
+      elif rv["epoch"] == self.sht.epoch and rv["seq"] > self.sht.seq:
+        # the backup has applied writes this primary no longer has, say
+        # after a restart without its log; a snapshot would throw them
+        # away, so leave the group to promote the backup instead
+        print "Peer %s is ahead at seq %d, stepping down" % (self.url, rv["seq"])
+        self.sht.step_down(rv["epoch"])
+        break
+      next_seq = rv["seq"] + 1
+
+
 # Presents a HT interface
+#
+# With a WriteAheadLog every put is logged and only acknowledged once it
+# is durable.  On start the last checkpoint (<log>.snap) is loaded and the
+# log replayed over it, which also restores the seq and epoch.  The XmlRpc server is threaded so that puts
+# waiting on the same fsync can be in flight together, and so that a put
+# waiting out an unreachable lease holder does not hold up other clients;
+# self.lock keeps the table and the log order consistent.
+#
+# For replication the servers of a group are started with each other as
+# peers, one as primary and the rest as backups.  Every mutation gets the
+# next seq and is kept in a bounded backlog that a LogShipper per peer
+# sends on.  Backups refuse client puts and only answer gets while they
+# have heard from the primary within max_staleness seconds.  promote()
+# makes a backup the primary under a higher epoch; a server that hears
+# from a higher epoch steps down to backup.
 class SimpleHT():
-  def __init__(self):
+  def __init__(self, wal=None, role="primary", peers=(), max_staleness=2.0):
     self.quit =  0
     self.data = {}
+    self.versions = {}
+    # key -> {client callback url: lease expiry}, only kept by the primary
+    self.leases = {}
+    self.lease_fence = 0
     self.next_check = datetime.now() + timedelta(minutes = 5)
+    self.lock = threading.RLock()
+    self.changed = threading.Condition(self.lock)
+    self.wal = wal
+    self.role = role
+    self.epoch = 0
+    self.seq = 0
+    self.backlog = deque()
+    self.peers = list(peers)
+    self.shippers = []
+    self.max_staleness = max_staleness
+    self.last_heard = 0
+    if wal is not None:
+      self.recover()
+      wal.start()
+    if role == "primary":
+      self.start_shipping()
 
   def count(self):
     # Remove expired entries
@@ -48,43 +282,325 @@ class SimpleHT():
     self.check()
     return len(self.data)
 
-  # Retrieve something from the HT
-  def get(self, key):
+  # Retrieve something from the HT.  A client passing its callback url is
+  # granted a lease on the key, hit or miss, for "lease" seconds
+  def get(self, key, client=""):
     # Remove expired entries
     self.check()
     # Default return value
     rv = {}
     # If the key is in the data structure, return properly formated results
     key = key.data
-    if key in self.data:
-      ent = self.data[key]
-      now = datetime.now()
-      if ent[1] > now:
-        ttl = (ent[1] - now).seconds
-        rv = {"value": Binary(ent[0]), "ttl": ttl}
-      else:
-        del self.data[key]
+    with self.lock:
+      if self.role != "primary" and time.time() - self.last_heard > self.max_staleness:
+        raise xmlrpclib.Fault(STALE, "backup is more than %gs behind" % self.max_staleness)
+      if key in self.data:
+        ent = self.data[key]
+        now = datetime.now()
+        if ent[1] > now:
+          ttl = (ent[1] - now).seconds
+          rv = {"value": Binary(ent[0]), "ttl": ttl, "version": self.versions.get(key, 0)}
+        else:
+          del self.data[key]
+      # backups never see the writes that would revoke a lease
+      if client and self.role == "primary":
+        self.leases.setdefault(key, {})[client] = time.time() + LEASE_TERM
+        rv["lease"] = LEASE_TERM
     return rv
 
   # Insert something into the HT
-  def put(self, key, value, ttl):
+  def put(self, key, value, ttl, client=""):
     # Remove expired entries
     self.check()
+    self.wait_fence()
     end = datetime.now() + timedelta(seconds = ttl)
-    self.data[key.data] = (value.data, end)
+    revokes = {}
+    with self.lock:
+      if self.role != "primary":
+        raise xmlrpclib.Fault(NOT_PRIMARY, "not the primary")
+      lsn = self.store(key.data, value.data, end)
+      self.recall(key.data, client, revokes)
+    self.revoke(revokes)
+    self.sync(lsn)
+    return True
+
+  # All of items applied under the lock and made durable with one sync
+  def put_many(self, items, ttl, client=""):
+    self.check()
+    self.wait_fence()
+    end = datetime.now() + timedelta(seconds = ttl)
+    lsn = 0
+    revokes = {}
+    with self.lock:
+      if self.role != "primary":
+        raise xmlrpclib.Fault(NOT_PRIMARY, "not the primary")
+      for key, value in items:
+        lsn = self.store(key.data, value.data, end)
+        self.recall(key.data, client, revokes)
+    self.revoke(revokes)
+    self.sync(lsn)
+    return [True] * len(items)
+
+  # Apply puts only if every [key, version] in checks still holds, version
+  # 0 standing for a key that is absent or expired.  Returns the outcome
+  # and each checked key's version after the call
+  def txn(self, checks, puts, ttl, client=""):
+    self.check()
+    self.wait_fence()
+    end = datetime.now() + timedelta(seconds = ttl)
+    lsn = 0
+    revokes = {}
+    with self.lock:
+      if self.role != "primary":
+        raise xmlrpclib.Fault(NOT_PRIMARY, "not the primary")
+      ok = all(self.version(key.data) == version for key, version in checks)
+      if ok:
+        for key, value in puts:
+          lsn = self.store(key.data, value.data, end)
+          self.recall(key.data, client, revokes)
+      versions = [self.version(key.data) for key, version in checks]
+    self.revoke(revokes)
+    self.sync(lsn)
+    return {"ok": ok, "versions": versions}
+
+  # Take the leases other clients hold on a key that is being written, under
+  # self.lock; revokes maps each holder to its keys and latest expiry
+  def recall(self, key, client, revokes):
+    holders = self.leases.pop(key, None)
+    if not holders:
+      return
+    now = time.time()
+    for holder, expiry in holders.items():
+      if holder != client and expiry > now:
+        keys, latest = revokes.get(holder, ([], 0))
+        keys.append(key)
+        revokes[holder] = (keys, max(latest, expiry))
+
+  # Call back the holders of recalled leases before the write is
+  # acknowledged, outwaiting the lease of any holder that cannot be reached
+  def revoke(self, revokes):
+    for holder, (keys, expiry) in revokes.items():
+      try:
+        xmlrpclib.Server(holder, transport = CallbackTransport()).invalidate([Binary(key) for key in keys])
+      except (socket.error, xmlrpclib.Error):
+        wait = expiry - time.time()
+        if wait > 0:
+          time.sleep(wait)
+
+  # A new primary knows nothing of the leases its predecessor granted, so
+  # it takes no writes until they have all run out
+  def wait_fence(self):
+    wait = self.lease_fence - time.time()
+    if wait > 0:
+      time.sleep(wait)
+
+  def cas(self, key, version, value, ttl):
+    rv = self.txn([(key, version)], [(key, value)], ttl)
+    return {"ok": rv["ok"], "version": rv["versions"][0]}
+
+  def version(self, key):
+    if key in self.data and self.data[key][1] > datetime.now():
+      return self.versions.get(key, 0)
+    return 0
+
+  # Set a key and log it, under self.lock; returns the lsn.  Versions keep
+  # counting across expiry so an old version never matches a new value
+  def store(self, key, value, end):
+    version = self.versions.get(key, 0) + 1
+    self.data[key] = (value, end)
+    self.versions[key] = version
+    return self.log(("put", key, value, end, version))
+
+  # Log a mutation, made while holding self.lock, and return its lsn.  The
+  # log holds (seq, epoch, record) so a restart resumes at the same seq
+  def log(self, record):
+    self.seq += 1
+    if self.peers:
+      self.backlog.append((self.seq, record))
+      if len(self.backlog) > BACKLOG_SIZE:
+        self.backlog.popleft()
+      self.changed.notify_all()
+    if self.wal is None:
+      return 0
+    return self.wal.append((self.seq, self.epoch, record))
+
+  # Make a new epoch durable, under self.lock
+  def log_epoch(self):
+    if self.wal is not None:
+      self.wal.wait(self.wal.append((self.seq, self.epoch, None)))
+
+  def start_shipping(self):
+    self.shippers = [LogShipper(self, url) for url in self.peers]
+    for shipper in self.shippers:
+      shipper.start()
+
+  def step_down(self, epoch):
+    with self.lock:
+      if epoch != self.epoch:
+        self.epoch = epoch
+        self.log_epoch()
+      if self.role == "primary":
+        print "Stepping down to backup in epoch %d" % epoch
+      self.role = "backup"
+      for shipper in self.shippers:
+        shipper.running = False
+      self.shippers = []
+      self.changed.notify_all()
+
+  # (records from next_seq on, current seq), waiting up to timeout for a
+  # record to arrive.  None if they are no longer (or not yet) in the
+  # backlog.
+  def backlog_from(self, next_seq, timeout):
+    with self.changed:
+      if self.seq < next_seq:
+        self.changed.wait(timeout)
+      if next_seq == self.seq + 1:
+        return [], self.seq
+      if next_seq > self.seq or not self.backlog or self.backlog[0][0] > next_seq:
+        return None
+      start = next_seq - self.backlog[0][0]
+      return [record for seq, record in islice(self.backlog, start, start + SHIP_BATCH)], self.seq
+
+  def reply(self, ok):
+    return {"ok": ok, "epoch": self.epoch, "seq": self.seq, "role": self.role}
+
+  # Called by the primary's LogShipper.  Only a shipment that brings this
+  # backup up to the primary's head refreshes last_heard, so partial
+  # catch-up batches do not make a lagging backup look fresh.
+  def apply_log(self, epoch, first_seq, records, head):
+    records = pickle.loads(records.data)
+    with self.lock:
+      if epoch < self.epoch:
+        return self.reply(False)
+      if epoch > self.epoch:
+        self.step_down(epoch)
+      elif self.role == "primary":
+        return self.reply(False)
+      if records and first_seq != self.seq + 1:
+        return self.reply(False)
+      lsn = 0
+      for record in records:
+        self.apply(record)
+        lsn = self.log(record)
+      if self.seq >= head:
+        self.last_heard = time.time()
+    self.sync(lsn)
+    return self.reply(True)
+
+  # Called by the primary's LogShipper when this backup is too far behind
+  def install_snapshot(self, epoch, seq, data):
+    data = pickle.loads(data.data)
+    with self.lock:
+      if epoch < self.epoch:
+        return self.reply(False)
+      if epoch > self.epoch:
+        self.step_down(epoch)
+      elif self.role == "primary" or seq < self.seq:
+        # a primary of the same epoch behind this backup has lost writes
+        return self.reply(False)
+      self.load_state(data)
+      self.seq = seq
+      self.backlog.clear()
+      self.last_heard = time.time()
+      self.checkpoint()
+    return self.reply(True)
+
+  # Make this server the primary of its group
+  def promote(self):
+    with self.lock:
+      if self.role == "primary":
+        return True
+      self.role = "primary"
+      self.epoch += 1
+      self.log_epoch()
+      self.lease_fence = time.time() + LEASE_TERM
+      print "Promoted to primary in epoch %d" % self.epoch
+      self.start_shipping()
+    return True
+
+  def status(self):
+    with self.lock:
+      rv = self.reply(True)
+      rv["staleness"] = time.time() - self.last_heard if self.role != "primary" else 0.0
+    return rv
+
+  # Wait for a logged mutation to be durable
+  def sync(self, lsn):
+    if self.wal is not None:
+      self.wal.wait(lsn)
+
+  def apply(self, record):
+    if record[0] == "put":
+      key, value, end = record[1:4]
+      self.data[key] = (value, end)
+      # records logged before versions were kept count up by one
+      self.versions[key] = record[4] if len(record) > 4 else self.versions.get(key, 0) + 1
+
+  # The table and its key versions as one picklable object, and back; a
+  # plain dict is a table saved before versions were kept
+  def state(self):
+    return (self.data, self.versions)
+
+  def load_state(self, state):
+    if isinstance(state, tuple):
+      self.data, self.versions = state
+    else:
+      self.data, self.versions = state, {}
+
+  def recover(self):
+    snap = self.wal.path + ".snap"
+    if os.path.exists(snap):
+      f = open(snap, "rb")
+      saved = pickle.load(f)
+      f.close()
+      # (table, seq, epoch); older checkpoints hold only the table
+      if isinstance(saved, tuple) and len(saved) == 3:
+        saved, self.seq, self.epoch = saved
+      self.load_state(saved)
+    replayed = 0
+    for entry in self.wal.replay():
+      if isinstance(entry[0], str):
+        # a bare record, logged before seqs were kept
+        self.seq += 1
+        self.apply(entry)
+      else:
+        self.seq, self.epoch, record = entry
+        if record is not None:
+          self.apply(record)
+      replayed += 1
+    print "Recovered %d keys at seq %d, replayed %d log records" % (len(self.data), self.seq, replayed)
+
+  # Write the table to <log>.snap and empty the log
+  def checkpoint(self):
+    if self.wal is None:
+      return False
+    with self.lock:
+      tmp = self.wal.path + ".snap.tmp"
+      f = open(tmp, "wb")
+      pickle.dump((self.state(), self.seq, self.epoch), f, 2)
+      f.flush()
+      os.fsync(f.fileno())
+      f.close()
+      os.rename(tmp, self.wal.path + ".snap")
+      self.wal.truncate()
     return True
-    
-  # Load contents from a file
+
+  # Load contents from a file, not logged: checkpoint afterwards to keep it
   def read_file(self, filename):
     f = open(filename.data, "rb")
-    self.data = pickle.load(f)
+    data = pickle.load(f)
     f.close()
+    with self.lock:
+      self.data = data
+      # every loaded key counts as a new write
+      self.versions = dict((key, self.versions.get(key, 0) + 1) for key in data)
     return True
 
   # Write contents to a file
   def write_file(self, filename):
     f = open(filename.data, "wb")
-    pickle.dump(self.data, f)
+    with self.lock:
+      pickle.dump(self.data, f)
     f.close()
     return True
 
@@ -99,12 +615,18 @@ class SimpleHT():
     if self.next_check > now:
       return
     self.next_check = datetime.now() + timedelta(minutes = 5)
-    to_remove = []
-    for key, value in self.data.items():
-      if value[1] < now:
-        to_remove.append(key)
-    for key in to_remove:
-      del self.data[key]
+    with self.lock:
+      to_remove = []
+      for key, value in self.data.items():
+        if value[1] < now:
+          to_remove.append(key)
+      for key in to_remove:
+        del self.data[key]
+      # leases that ran out without the key being written
+      now = time.time()
+      for key, holders in self.leases.items():
+        if max(holders.values()) < now:
+          del self.leases[key]
 
   def corrupt(self):
     return
@@ -116,15 +638,43 @@ class SimpleHT():
        
 
 def main():
-  #optlist, args = getopt.getopt(sys.argv[1:], "", ["port=", "test"])
-  #server_handle = []
-  #print optlist," ",args
   print sys.argv
-  if len(sys.argv) < 2:
-    print 'usage: %s <meta server port> ' % sys.argv[0]
+  optlist, args = getopt.getopt(sys.argv[1:], "", ["bin-port=", "wal=", "commit-window=",
+                                                  "peers=", "backup", "max-staleness="])
+  if len(args) < 1:
+    print 'usage: %s [--bin-port=P] [--wal=FILE] [--commit-window=MS] [--peers=URL,URL] [--backup] [--max-staleness=S] <meta server ports> ' % sys.argv[0]
     sys.exit(1)
-  ports = sys.argv[1]
-  serve(int(ports))
+  ol = dict(optlist)
+  ports = map(int,args)
+  window = float(ol.get("--commit-window", 2)) / 1000
+  peers = [url for url in ol.get("--peers", "").split(",") if url]
+  role = "backup" if "--backup" in ol else "primary"
+  staleness = float(ol.get("--max-staleness", 2))
+  if len(ports) == 1:
+    bin_port = None
+    if "--bin-port" in ol:
+      bin_port = int(ol["--bin-port"])
+    serve(ports[0], bin_port, ol.get("--wal"), window, role, peers, staleness)
+    return
+  # several ports start one shard process each; shard i gets binary port
+  # P + i and log FILE-<port>
+  if peers:
+    print "--peers replicates a single shard, start each group separately"
+    sys.exit(1)
+  shards = []
+  for i, port in enumerate(ports):
+    opts = {"window": window, "role": role, "max_staleness": staleness}
+    if "--bin-port" in ol:
+      opts["bin_port"] = int(ol["--bin-port"]) + i
+    if "--wal" in ol:
+      opts["wal_path"] = "%s-%d" % (ol["--wal"], port)
+    shards.append((port, opts))
+  spool = Pool(len(shards),init_worker)
+  spool.map(serve_shard,shards)
+
+def serve_shard(args):
+  port, opts = args
+  serve(port, **opts)
 
 
 
@@ -139,36 +689,61 @@ def main():
   #serve(port)
   '''
 
+# XmlRpc server answering each request in its own thread
+class ThreadedXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
+  daemon_threads = True
+
 # Start the xmlrpc server
-def serve(port):
+def serve(port, bin_port=None, wal_path=None, window=0.002, role="primary", peers=(), max_staleness=2.0):
 
-  file_server = SimpleXMLRPCServer.SimpleXMLRPCServer(('', port))
+  wal = None
+  file_server = ThreadedXMLRPCServer(('', port))
+  if wal_path is not None:
+    wal = WriteAheadLog(wal_path, window)
+  sht = SimpleHT(wal, role, peers, max_staleness)
   file_server.register_introspection_functions()
-  sht = SimpleHT()
   file_server.register_function(sht.get)
   file_server.register_function(sht.put)
+  file_server.register_function(sht.put_many)
+  file_server.register_function(sht.cas)
+  file_server.register_function(sht.txn)
   file_server.register_function(sht.print_content)
   file_server.register_function(sht.read_file)
   file_server.register_function(sht.write_file)
+  file_server.register_function(sht.checkpoint)
+  file_server.register_function(sht.apply_log)
+  file_server.register_function(sht.install_snapshot)
+  file_server.register_function(sht.promote)
+  file_server.register_function(sht.status)
   file_server.register_function(sht.corrupt)
   file_server.register_function(sht.terminate)
+  frame_server = None
+  if bin_port:
+    frame_server = binproto.FrameServer(sht, bin_port)
+    print "BINARY SERVER is UP at port: ",bin_port
 
   print "SERVER is UP at port: ",port
   while not sht.quit:
     try:
-      file_server.handle_request()
+      if frame_server is None:
+        file_server.handle_request()
+      else:
+        for ready in frame_server.poll([file_server]):
+          ready.handle_request()
     except KeyboardInterrupt:
       print "closing"
       sht.quit =1
       
+  if frame_server is not None:
+    frame_server.close()
   print "SERVER is DOWN at port: ",port
 
   
 
 # Execute the xmlrpc in a thread ... needed for testing
 class serve_thread:
-  def __call__(self, port):
-    serve(port)
+  def __call__(self, port, **opts):
+    serve(port, **opts)
 
 # Wrapper functions so the tests don't need to be concerned about Binary blobs
 class Helper:
@@ -232,5 +807,148 @@ class SimpleHTTest(unittest.TestCase):
     self.assertTrue(helper.put("test", "test2", 20000))
     self.assertEqual(helper.get("test")["value"], "test2", "Store new value")
 
+  def test_txn(self):
+    sht = SimpleHT()
+    helper = Helper(sht)
+    self.assertEqual(sht.cas(Binary("dir"), 0, Binary("a"), 10000), {"ok": True, "version": 1})
+    self.assertFalse(sht.cas(Binary("dir"), 0, Binary("b"), 10000)["ok"], "Created twice")
+    self.assertEqual(helper.get("dir")["version"], 1)
+    checks = [(Binary("dir"), 1), (Binary("meta"), 0)]
+    puts = [(Binary("dir"), Binary("c")), (Binary("meta"), Binary("m"))]
+    self.assertEqual(sht.txn(checks, puts, 10000), {"ok": True, "versions": [2, 1]})
+    # a stale check applies none of the puts
+    rv = sht.txn(checks, [(Binary("dir"), Binary("d")), (Binary("other"), Binary("o"))], 10000)
+    self.assertEqual(rv, {"ok": False, "versions": [2, 1]})
+    self.assertEqual(helper.get("dir")["value"], "c")
+    self.assertEqual(helper.get("other"), {}, "Failed txn wrote a key")
+    # versions keep counting across expiry
+    helper.put("short", "s", 1)
+    time.sleep(1.5)
+    self.assertEqual(sht.cas(Binary("short"), 0, Binary("t"), 10000), {"ok": True, "version": 2})
+
+  def test_leases(self):
+    invalidated = []
+    callbacks = SimpleXMLRPCServer.SimpleXMLRPCServer(("127.0.0.1", 51254), logRequests = False)
+    callbacks.register_function(lambda keys: invalidated.extend(k.data for k in keys) or True, "invalidate")
+    callback_thread = threading.Thread(target=callbacks.serve_forever)
+    callback_thread.setDaemon(True)
+    callback_thread.start()
+    holder = "http://127.0.0.1:51254"
+    sht = SimpleHT()
+    helper = Helper(sht)
+    helper.put("dir", "a", 10000)
+    self.assertEqual(sht.get(Binary("dir"), holder)["lease"], LEASE_TERM)
+    # the holder's own write is not called back
+    sht.put(Binary("dir"), Binary("b"), 10000, holder)
+    self.assertEqual(invalidated, [])
+    sht.get(Binary("dir"), holder)
+    sht.get(Binary("missing"), holder)
+    sht.put_many([(Binary("dir"), Binary("c")), (Binary("missing"), Binary("d"))], 10000)
+    self.assertEqual(sorted(invalidated), ["dir", "missing"], "Lease holder not called back")
+    # a holder that cannot be reached is outwaited
+    sht.leases["dir"] = {"http://127.0.0.1:51255": time.time() + 1}
+    start = time.time()
+    helper.put("dir", "e", 10000)
+    self.assertTrue(time.time() - start > 0.9, "Unreachable lease not outwaited")
+    callbacks.shutdown()
+    # other clients are served while a put outwaits a lease
+    output_thread = threading.Thread(target=serve_thread(), args=(51256, ))
+    output_thread.setDaemon(True)
+    output_thread.start()
+    time.sleep(1)
+    rpc = xmlrpclib.Server("http://127.0.0.1:51256")
+    rpc.get(Binary("dir"), "http://127.0.0.1:51255")
+    writer = threading.Thread(target=Helper(xmlrpclib.Server("http://127.0.0.1:51256")).put,
+                              args=("dir", "f", 10000))
+    writer.setDaemon(True)
+    writer.start()
+    time.sleep(0.2)
+    start = time.time()
+    Helper(rpc).get("other")
+    self.assertTrue(time.time() - start < 1, "Server stalled by a lease revocation")
+    rpc.terminate()
+
+  def test_wal(self):
+    for name in ("test-wal", "test-wal.snap"):
+      if os.path.exists(name):
+        os.remove(name)
+    sht = SimpleHT(WriteAheadLog("test-wal", 0.01))
+    helper = Helper(sht)
+    def writer(n):
+      for i in range(10):
+        helper.put("key%d-%d" % (n, i), "value%d" % i, 10000)
+    threads = [threading.Thread(target=writer, args=(n, )) for n in range(10)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertTrue(sht.wal.syncs < 100, "Puts were not group committed")
+    # a restart replays the log
+    helper = Helper(SimpleHT(WriteAheadLog("test-wal")))
+    self.assertEqual(helper.get("key9-9")["value"], "value9", "Log not replayed")
+    self.assertEqual(helper.caller.count(), 100, "Lost logged puts")
+    self.assertEqual(helper.caller.seq, 100, "Seq not restored from the log")
+    helper.caller.role = "backup"
+    self.assertTrue(helper.caller.promote())
+    # a checkpoint empties the log and is loaded on restart
+    self.assertTrue(helper.caller.checkpoint())
+    self.assertEqual(os.path.getsize("test-wal"), 0, "Log not emptied")
+    helper.put("after", "checkpoint", 10000)
+    # a torn record at the tail is dropped
+    f = open("test-wal", "ab")
+    f.write(LOG_HDR.pack(100, 0) + "torn")
+    f.close()
+    helper = Helper(SimpleHT(WriteAheadLog("test-wal")))
+    self.assertEqual(helper.get("key0-0")["value"], "value0", "Checkpoint not loaded")
+    self.assertEqual(helper.get("after")["value"], "checkpoint", "Lost put after checkpoint")
+    self.assertEqual((helper.caller.seq, helper.caller.epoch), (101, 1), "Seq or epoch lost")
+    helper.put("after", "torn tail", 10000)
+    helper = Helper(SimpleHT(WriteAheadLog("test-wal")))
+    self.assertEqual(helper.get("after")["value"], "torn tail", "Appended after a torn tail")
+    for name in ("test-wal", "test-wal.snap"):
+      os.remove(name)
+
+  def test_replication(self):
+    output_thread = threading.Thread(target=serve_thread(), args=(51252, ),
+                                     kwargs={"role": "backup", "max_staleness": 1.0})
+    output_thread.setDaemon(True)
+    output_thread.start()
+    time.sleep(1)
+    rpc = xmlrpclib.Server("http://127.0.0.1:51252")
+    primary = SimpleHT(peers=["http://127.0.0.1:51252"])
+    helper = Helper(primary)
+    for i in range(20):
+      helper.put("key%d" % i, "value%d" % i, 10000)
+    deadline = time.time() + 5
+    while rpc.status()["seq"] < primary.seq and time.time() < deadline:
+      time.sleep(0.1)
+    backup = Helper(rpc)
+    self.assertEqual(backup.get("key19")["value"], "value19", "Log not shipped")
+    # a batch that leaves a backup behind the primary does not freshen it
+    lagging = SimpleHT(role="backup")
+    batch = [("put", "key%d" % i, "value", 0, 1) for i in range(3)]
+    lagging.apply_log(0, 1, Binary(pickle.dumps(batch[:2], 2)), 3)
+    self.assertTrue(lagging.status()["staleness"] > 1.0, "Partial batch refreshed staleness")
+    lagging.apply_log(0, 3, Binary(pickle.dumps(batch[2:], 2)), 3)
+    self.assertTrue(lagging.status()["staleness"] < 1.0, "Caught up backup still stale")
+    self.assertRaises(xmlrpclib.Fault, backup.put, "key0", "stale", 10000)
+    # a primary restarted without its log finds the backup ahead of it
+    # and steps down rather than wiping it with its empty table
+    primary.step_down(0)
+    restarted = SimpleHT(peers=["http://127.0.0.1:51252"])
+    deadline = time.time() + 5
+    while restarted.role == "primary" and time.time() < deadline:
+      time.sleep(0.1)
+    self.assertEqual(restarted.role, "backup", "Restarted primary did not step down")
+    self.assertEqual(rpc.status()["seq"], 20, "Backup overwritten by a restarted primary")
+    # with the primary gone the backup stops answering once it is stale
+    time.sleep(1.5)
+    self.assertRaises(xmlrpclib.Fault, backup.get, "key0")
+    self.assertTrue(rpc.promote())
+    self.assertEqual(rpc.status()["epoch"], 1)
+    self.assertTrue(backup.put("key0", "promoted", 10000))
+    self.assertEqual(backup.get("key0")["value"], "promoted")
+    rpc.terminate()
+
 if __name__ == "__main__":
   main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Description:
+A read-only SimpleHT table laid out so it can be served straight from an
+mmap.  Opening one costs the same whatever its size; values are paged in
+by the OS the first time they are read.
+
+File layout, all integers big endian:
+  header   !8sQQQQ  MAGIC, entry count, bucket count, bucket offset,
+                    order offset
+  entries  per entry !IId key length, value length, expiry, then the key
+           and value bytes; written in key order
+  buckets  per bucket !QQ key hash, entry offset (0 for an empty bucket),
+           open addressing with linear probing
+  order    per entry !Q entry offset, in key order, for range scans
+"""
+
+import mmap, os, struct, hashlib
+
+MAGIC = "SHTMMAP1"
+HEADER = struct.Struct("!8sQQQQ")
+ENTRY = struct.Struct("!IId")
+BUCKET = struct.Struct("!QQ")
+OFFSET = struct.Struct("!Q")
+
+def key_hash(key):
+  return struct.unpack("!Q", hashlib.md5(key).digest()[:8])[0]
+
+
+# Write (key, value, expiry) entries, which must come in key order.  Only
+# the hash and offset of each entry are held in memory while the buckets
+# are built, keys and values are streamed out.  Goes through a temporary
+# file and a rename, so a table that is currently mapped stays valid.
+def write_table(filename, entries):
+  tmp = filename + ".tmp"
+  f = open(tmp, "wb")
+  f.write(HEADER.pack(MAGIC, 0, 0, 0, 0))
+  hashes = []
+  offsets = []
+  pos = HEADER.size
+  for key, value, expiry in entries:
+    f.write(ENTRY.pack(len(key), len(value), expiry))
+    f.write(key)
+    f.write(value)
+    hashes.append(key_hash(key))
+    offsets.append(pos)
+    pos += ENTRY.size + len(key) + len(value)
+  count = len(offsets)
+  # keep the load factor at or under one half
+  nbuckets = max(2 * count, 1)
+  table = [None] * nbuckets
+  for h, off in zip(hashes, offsets):
+    i = h % nbuckets
+    while table[i] is not None:
+      i = (i + 1) % nbuckets
+    table[i] = (h, off)
+  bucket_off = pos
+  for slot in table:
+    f.write(BUCKET.pack(*slot) if slot is not None else BUCKET.pack(0, 0))
+  order_off = bucket_off + nbuckets * BUCKET.size
+  for off in offsets:
+    f.write(OFFSET.pack(off))
+  f.seek(0)
+  f.write(HEADER.pack(MAGIC, count, nbuckets, bucket_off, order_off))
+  f.flush()
+  os.fsync(f.fileno())
+  f.close()
+  os.rename(tmp, filename)
+
+
+class MappedTable:
+  def __init__(self, filename):
+    self.file = open(filename, "rb")
+    self.map = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+    magic, self.count, self.nbuckets, self.bucket_off, self.order_off = \
+      HEADER.unpack_from(self.map, 0)
+    if magic != MAGIC:
+      self.close()
+      raise IOError("%s is not a mapped SimpleHT table" % filename)
+
+  def __len__(self):
+    return self.count
+
+  def close(self):
+    self.map.close()
+    self.file.close()
+
+  def entry(self, off):
+    klen, vlen, expiry = ENTRY.unpack_from(self.map, off)
+    kpos = off + ENTRY.size
+    return self.map[kpos:kpos + klen], kpos + klen, vlen, expiry
+
+  def find(self, key):
+    if not self.count:
+      return None
+    h = key_hash(key)
+    i = h % self.nbuckets
+    while True:
+      bh, off = BUCKET.unpack_from(self.map, self.bucket_off + i * BUCKET.size)
+      if off == 0:
+        return None
+      if bh == h:
+        k, vpos, vlen, expiry = self.entry(off)
+        if k == key:
+          return vpos, vlen, expiry
+      i = (i + 1) % self.nbuckets
+
+  def __contains__(self, key):
+    return self.find(key) is not None
+
+  # (value, expiry) for key, or None
+  def lookup(self, key):
+    found = self.find(key)
+    if found is None:
+      return None
+    vpos, vlen, expiry = found
+    return self.map[vpos:vpos + vlen], expiry
+
+  def key_at(self, n):
+    off = OFFSET.unpack_from(self.map, self.order_off + n * OFFSET.size)[0]
+    return self.entry(off)[0]
+
+  # Keys from lo onwards in order, lo itself only if inclusive
+  def iter_from(self, lo, inclusive=True):
+    first, last = 0, self.count
+    while first < last:
+      mid = (first + last) // 2
+      k = self.key_at(mid)
+      if k < lo or (k == lo and not inclusive):
+        first = mid + 1
+      else:
+        last = mid
+    for n in xrange(first, self.count):
+      yield self.key_at(n)
+
+  # (key, value, expiry) for every entry, in key order
+  def iteritems(self):
+    for n in xrange(self.count):
+      off = OFFSET.unpack_from(self.map, self.order_off + n * OFFSET.size)[0]
+      key, vpos, vlen, expiry = self.entry(off)
+      yield key, self.map[vpos:vpos + vlen], expiry
@@ -9,7 +9,11 @@ from time import time
 import datetime
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 from xmlrpclib import Binary
-import sys, pickle, xmlrpclib
+import sys, pickle, xmlrpclib, threading, unittest, random
+from collections import OrderedDict
+import blobcodec
+import mongo_backend
+import cache_backend
 
 import pymongo
 from pymongo import MongoClient
@@ -24,14 +28,24 @@ import memcache
 
 
 #$$$$$$$$$$$$$$$Need to remove below Line ###%%%%%%%%%%%%%%%%%%%%%###################
-fnodes = MongoClient('mongodb://localhost:27017/').filesys_database.filenodes.remove()
+fnodes = mongo_backend.filenodes('mongodb://localhost:27017/').remove()
 
 
 count = 0
-Max_CacheSize = 10
-Cache_cnt = 0
-Cache_Files = []
-Cache_Index = 0
+# memcached servers, host:port
+cache_servers = cache_backend.DEFAULT_SERVERS
+# which paths are in memcached, least recently used evicted first
+cache_index = cache_backend.LRUIndex(10)
+
+# Write-back limits: writers block on a flush past MAX_DIRTY_BYTES; every
+# FLUSH_INTERVAL seconds the flusher thread writes out everything once past
+# half of that, otherwise whatever has been dirty for FLUSH_AGE seconds
+MAX_DIRTY_BYTES = 64 * 1024 * 1024
+FLUSH_AGE = 5.0
+FLUSH_INTERVAL = 1.0
+max_dirty_bytes = MAX_DIRTY_BYTES
+flush_age = FLUSH_AGE
+write_back = None
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 
@@ -39,6 +53,117 @@ if not hasattr(__builtins__, 'bytes'):
     bytes = str
 
 
+# Node fields written since they were last stored in MongoDB.  The buffer,
+# not memcached, holds the only copy of such a field until it is flushed,
+# so neither an eviction nor memcached's own expiry can lose a write.
+# Fields are kept as the encoded blobs Mongo will store, which is also what
+# they are charged for against max_bytes.
+class WriteBackBuffer:
+    def __init__(self, max_bytes=MAX_DIRTY_BYTES, max_age=FLUSH_AGE):
+        self.max_bytes = max_bytes
+        self.flush_bytes = max_bytes / 2
+        self.max_age = max_age
+        # path -> [url, {field: blob}, first dirtied, bytes], oldest first
+        self.dirty = OrderedDict()
+        # entries taken out by the flush that is writing them
+        self.flushing = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        # one flush at a time, so an older copy never lands after a newer one
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def mark(self, path, url, key, value):
+        blob = blobcodec.dumps(value)
+        with self.lock:
+            entry = self.dirty.get(path)
+            if entry is None:
+                entry = self.dirty[path] = [url, {}, time(), 0]
+            old = entry[1].get(key)
+            grown = len(blob) - (len(old) if old is not None else 0)
+            entry[1][key] = blob
+            entry[3] += grown
+            self.bytes += grown
+            full = self.bytes > self.max_bytes
+        if full:
+            self.flush()
+
+    # (True, value) for a field that is not in MongoDB yet, else (False, None)
+    def lookup(self, path, key):
+        with self.lock:
+            for entries in (self.dirty, self.flushing):
+                entry = entries.get(path)
+                if entry is not None and key in entry[1]:
+                    blob = entry[1][key]
+                    break
+            else:
+                return False, None
+        return True, blobcodec.loads(blob)
+
+    # Write out the given paths, or every dirty path first dirtied at or
+    # before older_than, or all of them
+    def flush(self, paths=None, older_than=None):
+        with self.flush_lock:
+            with self.lock:
+                if paths is None:
+                    paths = []
+                    for path, entry in self.dirty.iteritems():
+                        if older_than is not None and entry[2] > older_than:
+                            break
+                        paths.append(path)
+                for path in paths:
+                    entry = self.dirty.pop(path, None)
+                    if entry is not None:
+                        self.bytes -= entry[3]
+                        self.flushing[path] = entry
+                batch = self.flushing
+            try:
+                self.write(batch)
+            except:
+                # put the entries back under anything written since, in
+                # first dirtied order so flushes by age still stop at the
+                # first young entry
+                with self.lock:
+                    for path, entry in batch.iteritems():
+                        newer = self.dirty.pop(path, None)
+                        if newer is not None:
+                            self.bytes -= newer[3]
+                            entry[1].update(newer[1])
+                            entry[3] = sum(len(blob) for blob in entry[1].itervalues())
+                        self.bytes += entry[3]
+                    entries = self.dirty.items() + batch.items()
+                    entries.sort(key=lambda item: item[1][2])
+                    self.dirty = OrderedDict(entries)
+                    self.flushing = {}
+                raise
+            with self.lock:
+                self.flushing = {}
+
+    # One bulk write for the whole flush
+    @mongo_backend.batched
+    def write(self, batch):
+        for path, entry in batch.iteritems():
+            mongo_backend.node_store(entry[0]).put(path, entry[1])
+
+    def run(self):
+        while not self.stopped.wait(FLUSH_INTERVAL):
+            try:
+                if self.bytes > self.flush_bytes:
+                    self.flush()
+                else:
+                    self.flush(older_than=time() - self.max_age)
+            except Exception, e:
+                print "write-back flush failed:", e
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+
 class FileNode:
     def __init__(self,name,isFile,path,url):
         self.name = name
@@ -49,90 +174,54 @@ class FileNode:
         self.put("data","") # used if it is a file
         self.put("meta",{})
         self.put("list_nodes",{})# contains a tuple of <name:FileNode>  used only if it is a dir. 
-        Cache_cnt = 0
 
     def put(self,key,value):
-        hostname="127.0.0.1" 
-        port="11211"
-        hostname = "%s:%s" % (hostname, port)
-        server = memcache.Client([hostname])
+        server = cache_backend.get_cache(cache_servers)
         #Cache_entry = {"key":str(key), "value" : pickle.dumps(value)}
         C_key = str(self.path)
-        global Cache_Files 
-        global Cache_cnt 
+        write_back.mark(C_key, self.url, key, value)
        
-        print "Checking if entry is presetn","[ C_key",C_key, "][ Cache_Files", Cache_Files,"][ Value", (C_key in Cache_Files),"]"
-        if C_key in Cache_Files:
-            Cache_fetch = server.get(C_key)
+        print "Checking if entry is presetn","[ C_key",C_key, "][ Cached", len(cache_index),"][ Value", (C_key in cache_index),"]"
+        Cache_fetch = server.get(C_key) if cache_index.touch(C_key) else None
+        if Cache_fetch is not None:
             print "/n printing [Cache_fetch:", Cache_fetch, "]"
             Cache_fetch[key] = value
-            server.replace(C_key, Cache_fetch, 900)
-            Cache_Index = Cache_Files.index(C_key)
-            Cache_Files = Cache_Files[:Cache_Index]+Cache_Files[Cache_Index+1:]
-            Cache_Files = [C_key]+Cache_Files
+            server.replace(C_key, Cache_fetch, 900, blobcodec.MIN_SIZE)
+            self.evict(server, cache_index.update(C_key, cache_index.size_of(Cache_fetch)))
         else:
-            if Cache_cnt == Max_CacheSize:
-                print "When Cache is Full, [Cache_Files:", Cache_Files, "]"
-                Cache_fetch = server.get(Cache_Files[-1])
-                print "[Cache_Files[-1]:", Cache_Files[-1], "]....[Cache_fetch:", Cache_fetch, "]"
-                print "[Cache_fetch.keys():", Cache_fetch.keys(), "]"
-                for key_type in Cache_fetch.keys():
-                    print "[Key_TYPE:", key_type, "]"
-                    self.db_put(Cache_Files[-1],key_type,Cache_fetch[key_type])
-                    
-                server.delete(Cache_Files[-1])
-                Cache_Files = Cache_Files[:-1]
-                print "After deleting last item,", Cache_Files
-                
             Cache_entry = {key: value}
+            self.evict(server, cache_index.add(C_key, cache_index.size_of(Cache_entry)))
             print "While writing to Cache: [C_key = ", C_key, "][ Cache_entry = ", Cache_entry, "][key = ", key, "][value = ", value, "]"
-            server.set(C_key, Cache_entry, 900)
-            print "Cache array",Cache_Files, C_key
-            Cache_Files = [C_key]+Cache_Files
-            #Cache_Index = (Cache_Index+1)%10
-            if Cache_cnt < Max_CacheSize: 
-                Cache_cnt = Cache_cnt+1
+            server.set(C_key, Cache_entry, 900, blobcodec.MIN_SIZE)
+                    
+    # Unflushed fields are held by write_back, so an evicted entry can
+    # simply be dropped
+    def evict(self, server, old_keys):
+        for old_key in old_keys:
+            print "Evicting", old_key
+            server.delete(old_key)
                     
     def get(self,key): 
-        hostname="127.0.0.1" 
-        port="11211"
-        hostname = "%s:%s" % (hostname, port)
-        server = memcache.Client([hostname])
+        server = cache_backend.get_cache(cache_servers)
         C_key = str(self.path)
-        global Cache_Files
-        global Cache_cnt
         
-        Cache_fetch = server.get(C_key)
-        print "/n [Cache-FILES:", Cache_Files, "] [Cache_fetch:", Cache_fetch,"]"
-        if C_key in Cache_Files:
-            print "/n present in Cache"
-            Cache_Index = Cache_Files.index(C_key)
-            Cache_Files = Cache_Files[:Cache_Index]+Cache_Files[Cache_Index+1:]
-            Cache_Files = [C_key]+Cache_Files
-            print "/n [Printing from Cache:", server.get(C_key), "][C_key:", C_key, "][Key:", key,"]"
-            return (server.get(C_key)[key])
-        else:
-            return self.db_get(key)
-            
+        if cache_index.touch(C_key):
+            Cache_fetch = server.get(C_key)
+            print "/n [Printing from Cache:", Cache_fetch, "][C_key:", C_key, "][Key:", key,"]"
+            if Cache_fetch is not None and key in Cache_fetch:
+                return Cache_fetch[key]
+        # memcached may have dropped a field Mongo does not have yet
+        found, value = write_back.lookup(C_key, key)
+        if found:
+            return value
+        return self.db_get(key)
             
-    def db_put(self,path,key,value):
-        client = MongoClient(self.url)
-        fs_db = client.filesys_database
-        fnodes = fs_db.filenodes
-        #dict_temp = {str(self.path) : key , str(key): pickle.dumps(value)}
-        Node_id = fnodes.update({str(path) : key},{'$set': {str(key): pickle.dumps(value)}},upsert = True)
-        print Node_id , "dbug node id"
-        
     def db_get(self,key):
-        client = MongoClient(self.url)
-        fs_db = client.filesys_database
-        fnodes = fs_db.filenodes
-        res = fnodes.find_one({str(self.path):key})
-        print "get key", {str(self.path):key}
-        print "PRINTING RES", res, "KEY", key, "RES.KEYS()", res.keys()
-        if key in res.keys():
+        res = mongo_backend.node_store(self.url).get(str(self.path), [key])
+        print "PRINTING RES", res, "KEY", key
+        if res is not None and key in res:
             #print "rv: = 1", pickle.loads(res[key])
-            return pickle.loads(res[key])
+            return blobcodec.loads(res[key])
         else:
             return None
         
@@ -190,6 +279,14 @@ class FS:
         return self.get_node(self.root,PATH,name) 
 
 
+    # The key a node's fields are stored and buffered under: the path it was
+    # created at, which a rename does not change.  None if there is no node
+    def node_key(self,path):
+        node = self.get_node_wrapper(path)
+        if node is None:
+            return None
+        return str(node.path)
+
     def get_node(self,parent,PATH,name):
         next_node = parent.contains_node(PATH[1])
         if (next_node == None or next_node.name == name):
@@ -338,10 +435,12 @@ class Memory(LoggingMixIn, Operations):
 
     def __init__(self,url):
         global count # count is a global variable, can be used inside any function.
+        global write_back
         count +=1 # increment count for very method call, to track count of calls made.
         print ("CallCount {} " " Time {}".format(count,datetime.datetime.now().time())) # print the parameters passed to the method as input.(used for debugging)
         print('In function __init__()') #print name of the method called
 
+        write_back = WriteBackBuffer(max_dirty_bytes, flush_age)
         self.FS = FS(url)
        
         
@@ -493,6 +592,37 @@ class Memory(LoggingMixIn, Operations):
         print('In function chown()')
 
         self.FS.update_meta(path,uid=uid,gid=gid)
+
+    def fsync(self, path, datasync, fh):
+        global count
+        count +=1
+        print ("CallCount {} " " Time {} Path {}".format(count,datetime.datetime.now().time(),path))
+        print('In function fsync()')
+
+        key = self.FS.node_key(path)
+        if key is not None:
+            write_back.flush([key])
+        return 0
+
+    def release(self, path, fh):
+        global count
+        count +=1
+        print ("CallCount {} " " Time {} Path {}".format(count,datetime.datetime.now().time(),path))
+        print('In function release()')
+
+        key = self.FS.node_key(path)
+        if key is not None:
+            write_back.flush([key])
+        return 0
+
+    # unmount: stop the flusher and write out everything still dirty
+    def destroy(self, path):
+        global count
+        count +=1
+        print ("CallCount {} " " Time {}".format(count,datetime.datetime.now().time()))
+        print('In function destroy()')
+
+        write_back.stop()
         
         
     
@@ -501,10 +631,116 @@ class Memory(LoggingMixIn, Operations):
         
 
    
+# python -m unittest CachedFS_WriteBack; importing the module needs MongoDB
+# up, the buffer's own writes are recorded instead of stored
+class WriteBackBufferTest(unittest.TestCase):
+    def setUp(self):
+        test = self
+        self.written = []
+        self.down = False
+        self.during_write = None
+        class Buffer(WriteBackBuffer):
+            def write(self, batch):
+                # the flusher thread's periodic flushes are mostly empty
+                if not batch:
+                    return
+                if test.during_write is not None:
+                    test.during_write()
+                if test.down:
+                    raise IOError("MongoDB down")
+                test.written.append(dict((path, dict((key, blobcodec.loads(blob)) for key, blob in entry[1].items()))
+                                         for path, entry in batch.items()))
+        self.buffer = Buffer(1024 * 1024, 3600)
+
+    def tearDown(self):
+        self.down = False
+        self.during_write = None
+        self.buffer.stop()
+
+    def dirty_bytes(self):
+        return sum(entry[3] for entry in self.buffer.dirty.values())
+
+    def test_flush(self):
+        buf = self.buffer
+        buf.mark("/a", "url", "meta", {"st_size": 3})
+        buf.mark("/a", "url", "data", "abc")
+        buf.mark("/b", "url", "data", "b" * 1000)
+        buf.mark("/a", "url", "data", "abcd")
+        self.assertEqual(buf.lookup("/a", "data"), (True, "abcd"))
+        self.assertEqual(buf.lookup("/a", "list_nodes"), (False, None))
+        self.assertEqual(buf.bytes, self.dirty_bytes(), "Bad accounting")
+        buf.flush(["/a"])
+        self.assertEqual(self.written, [{"/a": {"meta": {"st_size": 3}, "data": "abcd"}}])
+        self.assertEqual(buf.lookup("/a", "data"), (False, None), "Flushed field still dirty")
+        self.assertEqual(buf.bytes, self.dirty_bytes())
+        buf.flush()
+        self.assertEqual(self.written[1], {"/b": {"data": "b" * 1000}})
+        self.assertEqual(buf.bytes, 0)
+        self.assertEqual(buf.flushing, {})
+
+    def test_older_than(self):
+        buf = self.buffer
+        buf.mark("/old", "url", "data", "x")
+        buf.dirty["/old"][2] -= 60
+        buf.mark("/new", "url", "data", "y")
+        buf.flush(older_than=time() - 30)
+        self.assertEqual(self.written, [{"/old": {"data": "x"}}])
+        self.assertEqual(buf.dirty.keys(), ["/new"])
+
+    def test_full(self):
+        buf = self.buffer
+        # random, so compression cannot bring it under max_bytes
+        buf.mark("/big", "url", "data", "".join(chr(random.getrandbits(8)) for i in xrange(2 * 1024 * 1024)))
+        self.assertEqual(len(self.written), 1, "Full buffer not flushed")
+        self.assertEqual(buf.bytes, 0)
+
+    def test_requeue(self):
+        buf = self.buffer
+        buf.mark("/a", "url", "meta", {"st_size": 3})
+        buf.mark("/a", "url", "data", "old")
+        # a write made while the failing flush is in flight
+        self.during_write = lambda: buf.mark("/a", "url", "data", "new")
+        self.down = True
+        self.assertRaises(IOError, buf.flush)
+        self.during_write = None
+        self.assertEqual(buf.flushing, {})
+        self.assertEqual(buf.lookup("/a", "data"), (True, "new"), "Newer write lost on requeue")
+        self.assertEqual(buf.lookup("/a", "meta"), (True, {"st_size": 3}), "Failed write dropped")
+        self.assertEqual(buf.bytes, self.dirty_bytes(), "Bad accounting after requeue")
+        self.down = False
+        buf.flush()
+        self.assertEqual(self.written, [{"/a": {"meta": {"st_size": 3}, "data": "new"}}])
+        self.assertEqual(buf.bytes, 0)
+
+    # a requeued entry keeps its place in first dirtied order
+    def test_requeue_order(self):
+        buf = self.buffer
+        buf.mark("/a", "url", "data", "a")
+        buf.dirty["/a"][2] -= 60
+        buf.mark("/b", "url", "data", "b")
+        self.down = True
+        self.assertRaises(IOError, buf.flush, ["/a"])
+        self.assertEqual(buf.dirty.keys(), ["/a", "/b"], "Requeued entry moved behind younger ones")
+        self.down = False
+        buf.flush(older_than=time() - 30)
+        self.assertEqual(self.written, [{"/a": {"data": "a"}}], "Old requeued entry not flushed by age")
+        self.assertEqual(buf.dirty.keys(), ["/b"])
+
+
 if __name__ == "__main__":
-  if len(argv) != 3:
-    print 'usage: %s <mountpoint> <remote hashtable>' % argv[0]
+  argv, cache_index = cache_backend.index_from_args(argv)
+  for arg in argv[1:]:
+    if arg.startswith("--dirty-bytes="):
+      max_dirty_bytes = int(arg.split("=", 1)[1])
+    elif arg.startswith("--flush-age="):
+      flush_age = float(arg.split("=", 1)[1])
+  argv = [arg for arg in argv if not arg.startswith(("--dirty-bytes=", "--flush-age="))]
+  argv = mongo_backend.options_from_args(argv)
+  if len(argv) not in (3, 4):
+    print 'usage: %s [--cache-policy=lru|2q] [--cache-entries=N] [--cache-bytes=B] [--dirty-bytes=B] [--flush-age=S] [--write-concern=W] [--journal] <mountpoint> <remote hashtable> [memcached host:port,...]' % argv[0]
     exit(1)
   url = argv[2]
+  if len(argv) == 4:
+    cache_servers = cache_backend.parse_servers(argv[3])
   # Create a new HtProxy object using the URL specified at the command-line
   fuse = FUSE(Memory(url), argv[1], foreground=True, debug=True)
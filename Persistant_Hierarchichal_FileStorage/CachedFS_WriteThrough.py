@@ -10,6 +10,9 @@ import datetime
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 from xmlrpclib import Binary
 import sys, pickle, xmlrpclib
+import blobcodec
+import mongo_backend
+import cache_backend
 
 import pymongo
 from pymongo import MongoClient
@@ -24,14 +27,14 @@ import memcache
 
 
 #$$$$$$$$$$$$$$$Need to remove below Line ###%%%%%%%%%%%%%%%%%%%%%###################
-fnodes = MongoClient('mongodb://localhost:27017/').filesys_database.filenodes.remove()
+fnodes = mongo_backend.filenodes('mongodb://localhost:27017/').remove()
 
 
 count = 0
-Max_CacheSize = 10
-Cache_cnt = 0
-Cache_Files = []
-Cache_Index = 0
+# memcached servers, host:port
+cache_servers = cache_backend.DEFAULT_SERVERS
+# which paths are in memcached, least recently used evicted first
+cache_index = cache_backend.LRUIndex(10)
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 
@@ -49,7 +52,6 @@ class FileNode:
         self.put("data","") # used if it is a file
         self.put("meta",{})
         self.put("list_nodes",{})# contains a tuple of <name:FileNode>  used only if it is a dir. 
-        Cache_cnt = 0
 
     def put(self,key,value):
         self.C_put(key,value)
@@ -59,73 +61,54 @@ class FileNode:
         return self.C_get(key)
         
     def C_put(self,key,value):
-        hostname="127.0.0.1" 
-        port="11211"
-        hostname = "%s:%s" % (hostname, port)
-        server = memcache.Client([hostname])
+        server = cache_backend.get_cache(cache_servers)
         #Cache_entry = {"key":str(key), "value" : pickle.dumps(value)}
         C_key = str(self.path)
-        global Cache_Files 
-        global Cache_cnt 
        
-        print "Checking if entry is presetn","[ C_key",C_key, "][ Cache_Files", Cache_Files,"][ Value", (C_key in Cache_Files),"]"
-        if C_key in Cache_Files:
+        print "Checking if entry is presetn","[ C_key",C_key, "][ Cached", len(cache_index),"][ Value", (C_key in cache_index),"]"
+        Cache_fetch = None
+        if cache_index.touch(C_key):
             Cache_fetch = server.get(C_key)
             print "/n printing [Cache_fetch:", Cache_fetch, "]"
+        if Cache_fetch is not None:
             Cache_fetch[key] = value
-            server.replace(C_key, Cache_fetch, 900)
-            Cache_Index = Cache_Files.index(C_key)
-            Cache_Files = Cache_Files[:Cache_Index]+Cache_Files[Cache_Index+1:]
-            Cache_Files = [C_key]+Cache_Files
+            server.replace(C_key, Cache_fetch, 900, blobcodec.MIN_SIZE)
+            self.evict(server, cache_index.update(C_key, cache_index.size_of(Cache_fetch)))
         else:
-            if Cache_cnt == Max_CacheSize:
-                print "When Cache is Full, [Cache_Files:", Cache_Files, "]"
-                #Cache_fetch = server.get(Cache_Files[-1])
-                #print "[Cache_Files[-1]:", Cache_Files[-1], "]....[Cache_fetch:", Cache_fetch, "]"
-                #print "[Cache_fetch.keys():", Cache_fetch.keys(), "]"
-                #for key_type in Cache_fetch.keys():
-                    #print "[Key_TYPE:", key_type, "]"
-                    #self.db_put(Cache_Files[-1],key_type,Cache_fetch[key_type])
-                    
-                server.delete(Cache_Files[-1])
-                Cache_Files = Cache_Files[:-1]
-                print "After deleting last item,", Cache_Files
-                
+            # not cached, or dropped by memcached.  Only the field written is
+            # cached; C_get reads the others from Mongo when it misses them
             Cache_entry = {key: value}
+            self.evict(server, cache_index.add(C_key, cache_index.size_of(Cache_entry)))
             print "While writing to Cache: [C_key = ", C_key, "][ Cache_entry = ", Cache_entry, "][key = ", key, "][value = ", value, "]"
-            server.set(C_key, Cache_entry, 900)
-            print "Cache array",Cache_Files, C_key
-            Cache_Files = [C_key]+Cache_Files
-            #Cache_Index = (Cache_Index+1)%10
-            if Cache_cnt < Max_CacheSize: 
-                Cache_cnt = Cache_cnt+1
+            server.set(C_key, Cache_entry, 900, blobcodec.MIN_SIZE)
+                    
+    # MongoDB already has every write, evicted entries are just dropped
+    def evict(self, server, old_keys):
+        for old_key in old_keys:
+            print "Evicting", old_key
+            server.delete(old_key)
                     
     def C_get(self,key): 
-        hostname="127.0.0.1" 
-        port="11211"
-        hostname = "%s:%s" % (hostname, port)
-        server = memcache.Client([hostname])
+        server = cache_backend.get_cache(cache_servers)
         C_key = str(self.path)
-        global Cache_Files
-        global Cache_cnt
         
-        #Cache_fetch = server.get(C_key)
-        #print "/n [Cache-FILES:", Cache_Files, "] [Cache_fetch:", Cache_fetch,"]"
-        if C_key in Cache_Files:
+        Cache_fetch = None
+        if cache_index.touch(C_key):
+            Cache_fetch = server.get(C_key)
+        # memcached may have dropped it, then it is read back from Mongo
+        if Cache_fetch is not None and key in Cache_fetch:
             print C_key, " present in Cache"
-            Cache_Index = Cache_Files.index(C_key)
-            Cache_Files = Cache_Files[:Cache_Index]+Cache_Files[Cache_Index+1:]
-            Cache_Files = [C_key]+Cache_Files
-            print "/n [Printing from Cache:", server.get(C_key), "][C_key:", C_key, "][Key:", key,"]"
-            return (server.get(C_key)[key])
+            print "/n [Printing from Cache:", Cache_fetch, "][C_key:", C_key, "][Key:", key,"]"
+            return Cache_fetch[key]
         else:
             print C_key, " not present in Cache"
-            res = self.db_get(key)
+            res = self.db_get(key) or {}
             print "[Key:", key, "]  [PRINTING RES:", res,"]"
             print "[RES.KEYS():", res.keys(), "]"
             if key in res.keys():
-                Cache_entry = {"meta":pickle.loads(res["meta"]), "data": pickle.loads(res["data"]), "list_nodes": pickle.loads(res["list_nodes"])}
-                server.set(C_key, Cache_entry, 900)
+                Cache_entry = self.db_entry(res)
+                self.evict(server, cache_index.add(C_key, cache_index.size_of(Cache_entry)))
+                server.set(C_key, Cache_entry, 900, blobcodec.MIN_SIZE)
                 #print "KEY IS IN RES"
                 #self.C_put("meta", pickle.loads(res["meta"]))
                 #print "META WRITTEN"
@@ -134,25 +117,18 @@ class FileNode:
                 #self.C_put("list_nodes", pickle.loads(res["list_nodes"]))
                 print "LIST WRITTEN"
                 print "Check if Stored properly:", server.get(C_key)
-                return pickle.loads(res[key])
+                return blobcodec.loads(res[key])
             else:
                 print 
                 return None
                         
             
     def db_put(self,key,value):
-        client = MongoClient(self.url)
-        fs_db = client.filesys_database
-        fnodes = fs_db.filenodes
         #dict_temp = {str(self.path) : key , str(key): pickle.dumps(value)}
-        Node_id = fnodes.update({str(self.path) : key},{'$set': {str(key): pickle.dumps(value)}},upsert = True)
-        print Node_id , "dbug node id"
+        mongo_backend.node_store(self.url).put(str(self.path), {str(key): blobcodec.dumps(value)})
         
     def db_get(self,key):
-        client = MongoClient(self.url)
-        fs_db = client.filesys_database
-        fnodes = fs_db.filenodes
-        return fnodes.find_one({str(self.path):key})
+        return mongo_backend.node_store(self.url).get(str(self.path))
         print "get key", {str(self.path):key}
         print "PRINTING RES", res, "KEY", key, "RES.KEYS()", res.keys()
         if key in res.keys():
@@ -160,11 +136,19 @@ class FileNode:
             if ret_type == 1:
                 return res
             else:
-                return pickle.loads(res[key])
+                return blobcodec.loads(res[key])
         else:
             return None
         
         
+    # The node's fields in res, a NodeStore document, as the cache holds them
+    def db_entry(self, res):
+        Cache_entry = {}
+        for key_x in ("meta", "data", "list_nodes"):
+            if key_x in res:
+                Cache_entry[key_x] = blobcodec.loads(res[key_x])
+        return Cache_entry
+
     def set_data(self,data_blob):
         self.put("data",data_blob)
         
@@ -364,6 +348,7 @@ class FS:
 class Memory(LoggingMixIn, Operations):
     'Example memory filesystem. Supports only one level of files.'
 
+    @mongo_backend.batched
     def __init__(self,url):
         global count # count is a global variable, can be used inside any function.
         count +=1 # increment count for very method call, to track count of calls made.
@@ -407,6 +392,7 @@ class Memory(LoggingMixIn, Operations):
         print m
         return m
 
+    @mongo_backend.batched
     def mkdir(self, path, mode):
         global count
         count +=1
@@ -415,6 +401,7 @@ class Memory(LoggingMixIn, Operations):
         # create a file node
         self.FS.add_dir(path,mode)
 
+    @mongo_backend.batched
     def create(self, path, mode):
         global count
         count +=1
@@ -423,6 +410,7 @@ class Memory(LoggingMixIn, Operations):
         
         return self.FS.add_file(path,mode) # returns incremented fd.
 
+    @mongo_backend.batched
     def write(self, path, data, offset, fh):
         global count
         count +=1
@@ -450,6 +438,7 @@ class Memory(LoggingMixIn, Operations):
 
         return self.FS.read_file(path,offset,size)
 
+    @mongo_backend.batched
     def rename(self, old, new):
         global count
         count +=1
@@ -458,6 +447,7 @@ class Memory(LoggingMixIn, Operations):
 
         self.FS.rename_node(old,new)
 
+    @mongo_backend.batched
     def utimens(self, path, times=None):
         global count
         count +=1
@@ -466,6 +456,7 @@ class Memory(LoggingMixIn, Operations):
 
         self.FS.utimens(path,times)
 
+    @mongo_backend.batched
     def rmdir(self, path):
         global count
         count +=1
@@ -474,6 +465,7 @@ class Memory(LoggingMixIn, Operations):
 
         self.FS.delete_node(path)
 
+    @mongo_backend.batched
     def unlink(self, path):
         global count
         count +=1
@@ -482,6 +474,7 @@ class Memory(LoggingMixIn, Operations):
 
         self.FS.delete_node(path)
 
+    @mongo_backend.batched
     def symlink(self, target, source):
         global count
         count +=1
@@ -498,6 +491,7 @@ class Memory(LoggingMixIn, Operations):
         
         return self.FS.read_file(path)
 
+    @mongo_backend.batched
     def truncate(self, path, length, fh=None):
         global count
         print ("CallCount {} " " Time {}""," "arguments:" "path:{}" "," "length:{}" "," "fh:{}".format(count,datetime.datetime.now().time(),path,length,fh))
@@ -505,6 +499,7 @@ class Memory(LoggingMixIn, Operations):
         
         self.FS.write_file(path,offset=length)
 
+    @mongo_backend.batched
     def chmod(self, path, mode):
         global count
         count +=1
@@ -514,6 +509,7 @@ class Memory(LoggingMixIn, Operations):
         self.FS.update_meta(path,mode=mode)
         return 0
 
+    @mongo_backend.batched
     def chown(self, path, uid, gid):
         global count
         count +=1
@@ -530,9 +526,13 @@ class Memory(LoggingMixIn, Operations):
 
    
 if __name__ == "__main__":
-  if len(argv) != 3:
-    print 'usage: %s <mountpoint> <remote hashtable>' % argv[0]
+  argv, cache_index = cache_backend.index_from_args(argv)
+  argv = mongo_backend.options_from_args(argv)
+  if len(argv) not in (3, 4):
+    print 'usage: %s [--cache-policy=lru|2q] [--cache-entries=N] [--cache-bytes=B] [--write-concern=W] [--journal] <mountpoint> <remote hashtable> [memcached host:port,...]' % argv[0]
     exit(1)
   url = argv[2]
+  if len(argv) == 4:
+    cache_servers = cache_backend.parse_servers(argv[3])
   # Create a new HtProxy object using the URL specified at the command-line
   fuse = FUSE(Memory(url), argv[1], foreground=True, debug=True)
@@ -10,20 +10,24 @@ import datetime
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 from xmlrpclib import Binary
 import sys, pickle, xmlrpclib
+import blobcodec
+import mongo_backend
+import cache_backend
 
 import pymongo
 from pymongo import MongoClient
 import memcache
 
 
-fnodes = MongoClient('mongodb://localhost:27017/').filesys_database.filenodes.remove()
+fnodes = mongo_backend.filenodes('mongodb://localhost:27017/').remove()
 
-hostname = ""
+# memcached servers, host:port
+cache_servers = cache_backend.DEFAULT_SERVERS
 count = 0
-Max_CacheSize = 10
-Cache_cnt = 0
-Cache_Files = []
-Cache_Index = 0
+# which node fields are in memcached, least recently used evicted first
+cache_index = cache_backend.LRUIndex(30)
+# (path, field) -> value, in process, checked before memcached
+local_cache = cache_backend.LocalCache()
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 
@@ -51,70 +55,70 @@ class FileNode:
         return self.Cache_get(key)
         
     def Cache_put(self,key,value):
-        global Cache_Files 
-        global Cache_cnt         
-        server = memcache.Client([hostname])
         C_key = str(self.path)
-  
-        if C_key in Cache_Files:
-            Cache_fetch = server.get(C_key)
-            Cache_fetch[key] = value
-            server.replace(C_key, Cache_fetch, 900)
-            Cache_Index = Cache_Files.index(C_key)
-            Cache_Files = Cache_Files[:Cache_Index]+Cache_Files[Cache_Index+1:]
-            Cache_Files = [C_key]+Cache_Files
-        else:
-            Cache_entry = {key: value}
-            self.Cache_AddNewEntry(C_key, Cache_entry)
+        local_cache.put((C_key, key), value)
+        self.Cache_AddNewEntry(C_key, {key: value})
                     
+    # One memcached item per field, pickled here so its size is known; a
+    # field too big for an item is left to Mongo
     def Cache_AddNewEntry(self,C_key, Cache_entry):
-        global Cache_cnt
-        global Cache_Files
-        server = memcache.Client([hostname])
-        
-        if Cache_cnt >= Max_CacheSize:              
-            server.delete(Cache_Files[-1])
-            Cache_Files = Cache_Files[:-1]
-            
-        server.set(C_key, Cache_entry, 900)
-        Cache_Files = [C_key]+Cache_Files
-        if Cache_cnt < Max_CacheSize: 
-            Cache_cnt = Cache_cnt+1
+        server = cache_backend.get_cache(cache_servers)
+        items = {}
+        for key_x, value in Cache_entry.items():
+            F_key = cache_backend.field_key(C_key, key_x)
+            blob = pickle.dumps(value, 2)
+            if len(blob) > cache_backend.ITEM_LIMIT:
+                cache_index.discard(F_key)
+                server.delete(F_key)
+                continue
+            for old_key in cache_index.add(F_key, len(blob)):
+                server.delete(old_key)
+            items[F_key] = blob
+        if items:
+            server.set_multi(items, 900, blobcodec.MIN_SIZE)
     
     def Cache_get(self,key): 
-        global Cache_Files
-        global Cache_cnt
-        server = memcache.Client([hostname])
+        return self.get_many([key])[key]
+
+    # Several fields of the node: the local tier first, then one get_multi
+    # to memcached, then Mongo for whatever is still missing
+    def get_many(self,keys):
+        server = cache_backend.get_cache(cache_servers)
         C_key = str(self.path)
-        Cache_entry = {}
-   
-        if C_key in Cache_Files:
-            Cache_Index = Cache_Files.index(C_key)
-            Cache_Files = Cache_Files[:Cache_Index]+Cache_Files[Cache_Index+1:]
-            Cache_Files = [C_key]+Cache_Files
-            return (server.get(C_key)[key])
-        else:
-            res = self.db_get(key)         
-            if key in res.keys():
-                for key_x in res.keys():
-                    if key_x == "meta" or key_x == "data" or key_x == "list_nodes":
-                        Cache_entry[key_x] = pickle.loads(res[key_x])
-                self.Cache_AddNewEntry(C_key, Cache_entry)
-                return pickle.loads(res[key])
+        values = {}
+        wanted = {}
+        for key in keys:
+            found, value = local_cache.get((C_key, key))
+            if found:
+                values[key] = value
+                cache_index.touch(cache_backend.field_key(C_key, key))
             else:
-                return None                        
+                F_key = cache_backend.field_key(C_key, key)
+                if cache_index.touch(F_key):
+                    wanted[F_key] = key
+        if wanted:
+            # memcached may have dropped some, those are read from Mongo
+            for F_key, blob in server.get_multi(wanted.keys()).items():
+                values[wanted[F_key]] = pickle.loads(blob)
+                local_cache.put((C_key, wanted[F_key]), values[wanted[F_key]])
+        if len(values) < len(keys):
+            res = self.db_get([key for key in keys if key not in values])
+            Cache_entry = {}
+            for key_x in (res or {}).keys():
+                if key_x == "meta" or key_x == "data" or key_x == "list_nodes":
+                    Cache_entry[key_x] = blobcodec.loads(res[key_x])
+                    local_cache.put((C_key, key_x), Cache_entry[key_x])
+            self.Cache_AddNewEntry(C_key, Cache_entry)
+            for key in keys:
+                if key not in values:
+                    values[key] = Cache_entry.get(key)
+        return values
             
     def db_put(self,key,value):
-        client = MongoClient(self.url)
-        fs_db = client.filesys_database
-        fnodes = fs_db.filenodes
-        Node_id = fnodes.update({str(self.path) : "key"},{'$set': {str(key): pickle.dumps(value)}},upsert = True)
+        mongo_backend.node_store(self.url).put(str(self.path), {str(key): blobcodec.dumps(value)})
         
-    def db_get(self,key):
-        client = MongoClient(self.url)
-        fs_db = client.filesys_database
-        fnodes = fs_db.filenodes
-        return fnodes.find_one({str(self.path):"key"})
+    def db_get(self,keys):
+        return mongo_backend.node_store(self.url).get(str(self.path), keys)
                         
     def set_data(self,data_blob):
         self.put("data",data_blob)
@@ -141,9 +145,10 @@ class FileNode:
         if (self.isFile==True):
             return None
         else:
-            if name in self.get("list_nodes").keys():
-                print "List Nodes dict", self.get("list_nodes")
-                return self.get("list_nodes")[name]
+            list_nodes = self.get("list_nodes")
+            if name in list_nodes.keys():
+                print "List Nodes dict", list_nodes
+                return list_nodes[name]
             else:
                 return None
 
@@ -221,8 +226,9 @@ class FS:
         filenode = self.get_node_wrapper(path)
         # if data == None, this is just a truncate request,using offset as 
         # truncation parameter equivalent to length
-        node_data = filenode.get("data")
-        node_meta = filenode.get("meta")
+        fields = filenode.get_many(["data", "meta"])
+        node_data = fields["data"]
+        node_meta = fields["meta"]
         if (data==None):
             node_data = node_data[:offset]
             node_meta['st_size'] = offset
@@ -315,15 +321,16 @@ class FS:
 class Memory(LoggingMixIn, Operations):
     'Example memory filesystem. Supports only one level of files.'
 
+    @mongo_backend.batched
     def __init__(self,url, MemC_url):
         
-        global hostname
+        global cache_servers
         global count # count is a global variable, can be used inside any function.
         count +=1 # increment count for very method call, to track count of calls made.
         print ("CallCount {} " " Time {}".format(count,datetime.datetime.now().time())) # print the parameters passed to the method as input.(used for debugging)
         print('In function __init__()') #print name of the method called
 
-        hostname = MemC_url
+        cache_servers = cache_backend.parse_servers(MemC_url)
         self.FS = FS(url)
                
                
@@ -351,6 +358,7 @@ class Memory(LoggingMixIn, Operations):
         print m
         return m
 
+    @mongo_backend.batched
     def mkdir(self, path, mode):
         global count
         count +=1
@@ -359,6 +367,7 @@ class Memory(LoggingMixIn, Operations):
         # create a file node
         self.FS.add_dir(path,mode)
 
+    @mongo_backend.batched
     def create(self, path, mode):
         global count
         count +=1
@@ -367,6 +376,7 @@ class Memory(LoggingMixIn, Operations):
         
         return self.FS.add_file(path,mode) # returns incremented fd.
 
+    @mongo_backend.batched
     def write(self, path, data, offset, fh):
         global count
         count +=1
@@ -394,6 +404,7 @@ class Memory(LoggingMixIn, Operations):
 
         return self.FS.read_file(path,offset,size)
 
+    @mongo_backend.batched
     def rename(self, old, new):
         global count
         count +=1
@@ -402,6 +413,7 @@ class Memory(LoggingMixIn, Operations):
 
         self.FS.rename_node(old,new)
 
+    @mongo_backend.batched
     def utimens(self, path, times=None):
         global count
         count +=1
@@ -410,6 +422,7 @@ class Memory(LoggingMixIn, Operations):
 
         self.FS.utimens(path,times)
 
+    @mongo_backend.batched
     def rmdir(self, path):
         global count
         count +=1
@@ -418,6 +431,7 @@ class Memory(LoggingMixIn, Operations):
 
         self.FS.delete_node(path)
 
+    @mongo_backend.batched
     def unlink(self, path):
         global count
         count +=1
@@ -426,6 +440,7 @@ class Memory(LoggingMixIn, Operations):
 
         self.FS.delete_node(path)
 
+    @mongo_backend.batched
     def symlink(self, target, source):
         global count
         count +=1
@@ -442,6 +457,7 @@ class Memory(LoggingMixIn, Operations):
         
         return self.FS.read_file(path)
 
+    @mongo_backend.batched
     def truncate(self, path, length, fh=None):
         global count
         print ("CallCount {} " " Time {}""," "arguments:" "path:{}" "," "length:{}" "," "fh:{}".format(count,datetime.datetime.now().time(),path,length,fh))
@@ -449,6 +465,7 @@ class Memory(LoggingMixIn, Operations):
         
         self.FS.write_file(path,offset=length)
 
+    @mongo_backend.batched
     def chmod(self, path, mode):
         global count
         count +=1
@@ -458,6 +475,7 @@ class Memory(LoggingMixIn, Operations):
         self.FS.update_meta(path,mode=mode)
         return 0
 
+    @mongo_backend.batched
     def chown(self, path, uid, gid):
         global count
         count +=1
@@ -474,8 +492,11 @@ class Memory(LoggingMixIn, Operations):
 
    
 if __name__ == "__main__":
+  argv, cache_index = cache_backend.index_from_args(argv, max_entries=30)
+  argv, local_cache = cache_backend.local_from_args(argv)
+  argv = mongo_backend.options_from_args(argv)
   if len(argv) != 4:
-    print 'usage: %s <mountpoint> <MongoDB database url> <Memcache hostname>' % argv[0]
+    print 'usage: %s [--cache-policy=lru|2q] [--cache-entries=N] [--cache-bytes=B] [--local-bytes=B] [--local-ttl=S] [--write-concern=W] [--journal] <mountpoint> <MongoDB database url> <memcached host:port,...>' % argv[0]
     exit(1)
   url = argv[2]
   
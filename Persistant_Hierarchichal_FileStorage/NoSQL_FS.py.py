@@ -10,6 +10,8 @@ import datetime
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
 from xmlrpclib import Binary
 import sys, pickle, xmlrpclib
+import blobcodec
+import mongo_backend
 
 import pymongo
 from pymongo import MongoClient
@@ -19,7 +21,8 @@ from pymongo import MongoClient
 #fs_db = client.filesys_database
 #fnodes = fs_db.filenodes.remove()
 #fnodes = fs_db.filenodes
-fnodes = MongoClient('mongodb://localhost:27017/').filesys_database.filenodes.remove()
+fnodes = mongo_backend.filenodes('mongodb://localhost:27017/').remove()
+mongo_backend.chunks('mongodb://localhost:27017/').remove()
 count = 0
 
 from fuse import FUSE, FuseOSError, Operations, LoggingMixIn
@@ -35,42 +38,44 @@ class FileNode:
         self.path = path
         self.url = url    # 'mongodb://localhost:27017/'
         self.isFile = isFile # true if node is a file, false if is a directory.
-        self.put("data","") # used if it is a file
+        if isFile: # contents live in the chunk store, start empty
+            self.truncate_data(0)
         self.put("meta",{})
         self.put("list_nodes",{})# contains a tuple of <name:FileNode>  used only if it is a dir. 
 
     def put(self,key,value):
-        client = MongoClient(self.url)
-        fs_db = client.filesys_database
-        fnodes = fs_db.filenodes
-        #dict_temp = {str(self.path) : key , str(key): pickle.dumps(value)}
-        Node_id = fnodes.update({str(self.path) : key},{'$set': {str(key): pickle.dumps(value)}},upsert = True)
-        print Node_id , "dbug node id"
+        mongo_backend.node_store(self.url).put(str(self.path), {str(key): blobcodec.dumps(value)})
 
 
     def get(self,key):
-        client = MongoClient(self.url)
-        fs_db = client.filesys_database
-        fnodes = fs_db.filenodes
-        res = fnodes.find_one({str(self.path):key})
-        #print "get key", {str(self.path):key}
+        res = mongo_backend.node_store(self.url).get(str(self.path), [key])
         #print "PRINTING RES", res
-        if key in res.keys():
+        if res is not None and key in res:
             #print "rv: = 1", pickle.loads(res[key])
-            return pickle.loads(res[key])
+            return blobcodec.loads(res[key])
         else:
             return None
         
         
     def set_data(self,data_blob):
-        self.put("data",data_blob)
+        self.truncate_data(0)
+        self.write_data(0,data_blob)
+
+    def read_data(self,offset,size):
+        return mongo_backend.chunk_store(self.url).read(str(self.path),offset,size)
+
+    def write_data(self,offset,data):
+        mongo_backend.chunk_store(self.url).write(str(self.path),offset,data)
+
+    def truncate_data(self,length):
+        mongo_backend.chunk_store(self.url).truncate(str(self.path),length)
         
 
     def set_meta(self,meta):
         self.put("meta",meta)
 
     def get_data(self):
-        return self.get("data")
+        return self.read_data(0,self.get("meta").get("st_size",0))
 
     def get_meta(self):
         return self.get("meta")
@@ -164,15 +169,14 @@ class FS:
         filenode = self.get_node_wrapper(path)
         # if data == None, this is just a truncate request,using offset as 
         # truncation parameter equivalent to length
-        node_data = filenode.get("data")
         node_meta = filenode.get("meta")
         if (data==None):
-            node_data = node_data[:offset]
+            filenode.truncate_data(offset)
             node_meta['st_size'] = offset
         else:
-            node_data = node_data[:offset]+data
-            node_meta['st_size'] = len(node_data)
-        filenode.put("data",node_data)
+            # only the chunks under [offset, offset+len(data)) are touched
+            filenode.write_data(offset,data)
+            node_meta['st_size'] = max(node_meta.get('st_size',0),offset+len(data))
         filenode.put("meta",node_meta)
         
 
@@ -183,8 +187,9 @@ class FS:
         if (size==None):
             return filenode.get_data()
         else:
-            # return requested portion data
-            return filenode.get("data")[offset:offset + size]
+            # return requested portion data, up to the end of the file
+            size = min(size,filenode.get("meta").get("st_size",0)-offset)
+            return filenode.read_data(offset,size)
 
     def rename_node(self,old,new):
         # first check if parent exists i.e. destination path is valid
@@ -232,6 +237,8 @@ class FS:
             parents_meta = parent_filenode.get("meta")
             parents_meta["st_nlink"]-=1
             parent_filenode.put("meta",parents_meta)
+        else:
+            filenode.truncate_data(0)
 
     def link_nodes(self,target,source):
         # create a new target node.
@@ -258,6 +265,7 @@ class FS:
 class Memory(LoggingMixIn, Operations):
     'Example memory filesystem. Supports only one level of files.'
 
+    @mongo_backend.batched
     def __init__(self,url):
         global count # count is a global variable, can be used inside any function.
         count +=1 # increment count for very method call, to track count of calls made.
@@ -300,6 +308,7 @@ class Memory(LoggingMixIn, Operations):
         print m
         return m
 
+    @mongo_backend.batched
     def mkdir(self, path, mode):
         global count
         count +=1
@@ -308,6 +317,7 @@ class Memory(LoggingMixIn, Operations):
         # create a file node
         self.FS.add_dir(path,mode)
 
+    @mongo_backend.batched
     def create(self, path, mode):
         global count
         count +=1
@@ -316,6 +326,7 @@ class Memory(LoggingMixIn, Operations):
         
         return self.FS.add_file(path,mode) # returns incremented fd.
 
+    @mongo_backend.batched
     def write(self, path, data, offset, fh):
         global count
         count +=1
@@ -343,6 +354,7 @@ class Memory(LoggingMixIn, Operations):
 
         return self.FS.read_file(path,offset,size)
 
+    @mongo_backend.batched
     def rename(self, old, new):
         global count
         count +=1
@@ -351,6 +363,7 @@ class Memory(LoggingMixIn, Operations):
 
         self.FS.rename_node(old,new)
 
+    @mongo_backend.batched
     def utimens(self, path, times=None):
         global count
         count +=1
@@ -359,6 +372,7 @@ class Memory(LoggingMixIn, Operations):
 
         self.FS.utimens(path,times)
 
+    @mongo_backend.batched
     def rmdir(self, path):
         global count
         count +=1
@@ -367,6 +381,7 @@ class Memory(LoggingMixIn, Operations):
 
         self.FS.delete_node(path)
 
+    @mongo_backend.batched
     def unlink(self, path):
         global count
         count +=1
@@ -375,6 +390,7 @@ class Memory(LoggingMixIn, Operations):
 
         self.FS.delete_node(path)
 
+    @mongo_backend.batched
     def symlink(self, target, source):
         global count
         count +=1
@@ -391,6 +407,7 @@ class Memory(LoggingMixIn, Operations):
         
         return self.FS.read_file(path)
 
+    @mongo_backend.batched
     def truncate(self, path, length, fh=None):
         global count
         print ("CallCount {} " " Time {}""," "arguments:" "path:{}" "," "length:{}" "," "fh:{}".format(count,datetime.datetime.now().time(),path,length,fh))
@@ -398,6 +415,7 @@ class Memory(LoggingMixIn, Operations):
         
         self.FS.write_file(path,offset=length)
 
+    @mongo_backend.batched
     def chmod(self, path, mode):
         global count
         count +=1
@@ -407,6 +425,7 @@ class Memory(LoggingMixIn, Operations):
         self.FS.update_meta(path,mode=mode)
         return 0
 
+    @mongo_backend.batched
     def chown(self, path, uid, gid):
         global count
         count +=1
@@ -423,8 +442,9 @@ class Memory(LoggingMixIn, Operations):
 
    
 if __name__ == "__main__":
+  argv = mongo_backend.options_from_args(argv)
   if len(argv) != 3:
-    print 'usage: %s <mountpoint> <remote hashtable>' % argv[0]
+    print 'usage: %s [--write-concern=W] [--journal] <mountpoint> <remote hashtable>' % argv[0]
     exit(1)
   url = argv[2]
   # Create a new HtProxy object using the URL specified at the command-line
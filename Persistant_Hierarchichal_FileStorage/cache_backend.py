@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+"""
+The memcached tier of the cached file systems: one long-lived client per
+list of servers, spreading keys over them by consistent (ketama) hashing.
+
+Every server owns POINTS points on a ring of 32 bit md5 values and a key
+goes to the first point at or after its own hash.  Adding or losing one of
+N servers therefore only moves the keys on its points, about 1/N of them,
+where the modulo hashing of memcache.Client([...]) would move nearly all.
+A server that is down simply misses, and the file system falls back to
+Mongo for its keys.
+
+memcache.Client keeps its sockets per thread, so the shared client is safe
+to use from every FUSE thread.
+
+LRUIndex is the file systems' own record of which paths they have put in
+memcached, in recency order, bounded in entries and optionally in bytes.
+TwoQIndex has the same interface but keeps keys seen only once apart, so a
+scan of the whole tree cannot push out the entries that are in steady use.
+
+LocalCache is an in-process tier in front of memcached for the hottest
+fields, bounded in bytes, whose entries live for a short ttl.
+
+field_key() names the memcached item of one field of one node, so a stat
+fetches the few hundred bytes of meta and not the file contents with it.
+
+TwoQIndexTest covers the 2Q policy: python -m unittest cache_backend
+"""
+
+import bisect, hashlib, struct, threading, pickle, time, re, unittest
+from collections import defaultdict, OrderedDict
+import memcache
+
+DEFAULT_SERVERS = ["127.0.0.1:11211"]
+# memcached refuses keys over MAX_KEY bytes or with whitespace or control
+# characters, and by default items over 1 MB; ITEM_LIMIT leaves room for
+# the item header
+MAX_KEY = 250
+ITEM_LIMIT = 1000 * 1000
+_unsafe_key = re.compile(r"[\x00-\x20\x7f]")
+# in-process tier defaults; LOCAL_TTL bounds how stale it can be against
+# puts from other mounts, local puts update it directly
+LOCAL_BYTES = 8 * 1024 * 1024
+LOCAL_TTL = 1.0
+# 40 md5 digests of 4 points each per server, as libketama does
+POINTS = 160
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def parse_servers(arg):
+    # "host:port,host:port" from the command line
+    return [server for server in arg.split(",") if server]
+
+
+def ring_hash(data):
+    return struct.unpack("<I", hashlib.md5(data).digest()[:4])[0]
+
+
+class KetamaClient:
+    def __init__(self, servers):
+        self.servers = list(servers)
+        self.clients = dict((server, memcache.Client([server])) for server in self.servers)
+        ring = []
+        for server in self.servers:
+            for i in range(POINTS // 4):
+                digest = hashlib.md5("%s-%d" % (server, i)).digest()
+                for j in range(4):
+                    ring.append((struct.unpack("<I", digest[4 * j:4 * j + 4])[0], server))
+        ring.sort()
+        self.points = [point for point, server in ring]
+        self.owners = [server for point, server in ring]
+
+    def server_for(self, key):
+        i = bisect.bisect_left(self.points, ring_hash(key))
+        return self.owners[i % len(self.owners)]
+
+    def client_for(self, key):
+        return self.clients[self.server_for(key)]
+
+    def get(self, key):
+        return self.client_for(key).get(key)
+
+    def set(self, key, value, time=0, min_compress_len=0):
+        return self.client_for(key).set(key, value, time, min_compress_len)
+
+    def replace(self, key, value, time=0, min_compress_len=0):
+        return self.client_for(key).replace(key, value, time, min_compress_len)
+
+    def delete(self, key):
+        return self.client_for(key).delete(key)
+
+    def by_server(self, keys):
+        groups = defaultdict(list)
+        for key in keys:
+            groups[self.server_for(key)].append(key)
+        return groups
+
+    # One request per server for all of its keys
+    def get_multi(self, keys):
+        found = {}
+        for server, server_keys in self.by_server(keys).items():
+            found.update(self.clients[server].get_multi(server_keys))
+        return found
+
+    # Returns the keys that could not be stored
+    def set_multi(self, mapping, time=0, min_compress_len=0):
+        failed = []
+        for server, server_keys in self.by_server(mapping.keys()).items():
+            failed += self.clients[server].set_multi(dict((key, mapping[key]) for key in server_keys),
+                                                     time, min_compress_len=min_compress_len)
+        return failed
+
+    def delete_multi(self, keys):
+        ok = True
+        for server, server_keys in self.by_server(keys).items():
+            ok = self.clients[server].delete_multi(server_keys) and ok
+        return ok
+
+
+# Recency of the cached keys: an OrderedDict of key -> charged bytes, least
+# recently used first, so a hit or an insert is O(1).  add() returns the
+# keys pushed out past max_entries or max_bytes (0 for no byte bound) for
+# the caller to drop from memcached.
+class LRUIndex:
+    def __init__(self, max_entries=10, max_bytes=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    # Bytes to charge for a value, only measured when bytes are bounded
+    def size_of(self, value):
+        if not self.max_bytes:
+            return 0
+        return len(pickle.dumps(value, 2))
+
+    # Mark key used; False if it is not in the index
+    def touch(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self.entries[key] = self.entries.pop(key)
+            return True
+
+    def add(self, key, size=0):
+        with self.lock:
+            self.bytes -= self.entries.pop(key, 0)
+            self.entries[key] = size
+            self.bytes += size
+            return self.evict(key)
+
+    # New size of a key already in the index
+    def update(self, key, size):
+        with self.lock:
+            if key in self.entries:
+                self.bytes += size - self.entries[key]
+                self.entries[key] = size
+            return self.evict(key)
+
+    def discard(self, key):
+        with self.lock:
+            self.bytes -= self.entries.pop(key, 0)
+
+    # Called with the lock held; never evicts keep
+    def evict(self, keep):
+        evicted = []
+        while len(self.entries) > 1 and (len(self.entries) > self.max_entries or
+                                         (self.max_bytes and self.bytes > self.max_bytes)):
+            key, size = self.entries.popitem(last=False)
+            if key == keep:
+                self.entries[key] = size
+                continue
+            self.bytes -= size
+            evicted.append(key)
+        return evicted
+
+
+# 2Q (Johnson and Shasha): a new key goes into the FIFO recent, holding up
+# to RECENT_SHARE of the entries.  Hits in recent leave it where it is, so
+# a key read several times in quick succession is not taken for a reusable
+# one.  A key added again while remembered without a value in ghosts,
+# after falling out of recent, moves to entries, the LRU of keys that have
+# proved reusable.  A scan cycles through recent and leaves entries alone.
+class TwoQIndex(LRUIndex):
+    RECENT_SHARE = 0.25
+    GHOST_SHARE = 0.5
+
+    def __init__(self, max_entries=10, max_bytes=0):
+        LRUIndex.__init__(self, max_entries, max_bytes)
+        self.recent = OrderedDict()
+        self.ghosts = OrderedDict()
+        self.max_recent = max(1, int(max_entries * self.RECENT_SHARE))
+        self.max_ghosts = max(1, int(max_entries * self.GHOST_SHARE))
+
+    def __len__(self):
+        return len(self.entries) + len(self.recent)
+
+    def __contains__(self, key):
+        return key in self.entries or key in self.recent
+
+    def touch(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries[key] = self.entries.pop(key)
+                return True
+            return key in self.recent
+
+    def add(self, key, size=0):
+        with self.lock:
+            if key in self.recent:
+                self.bytes += size - self.recent[key]
+                self.recent[key] = size
+            elif key in self.entries or key in self.ghosts:
+                self.bytes += size - self.entries.pop(key, 0)
+                self.ghosts.pop(key, None)
+                self.entries[key] = size
+            else:
+                self.bytes += size
+                self.recent[key] = size
+            return self.evict(key)
+
+    def update(self, key, size):
+        with self.lock:
+            for queue in (self.entries, self.recent):
+                if key in queue:
+                    self.bytes += size - queue[key]
+                    queue[key] = size
+            return self.evict(key)
+
+    def discard(self, key):
+        with self.lock:
+            self.bytes -= self.entries.pop(key, 0) + self.recent.pop(key, 0)
+            self.ghosts.pop(key, None)
+
+    def full(self):
+        return len(self) > self.max_entries or \
+            (self.max_bytes and self.bytes > self.max_bytes)
+
+    def evict(self, keep):
+        evicted = []
+        while len(self) > 1 and self.full():
+            if self.recent and (len(self.recent) > self.max_recent or not self.entries):
+                queues = (self.recent, self.entries)
+            else:
+                queues = (self.entries, self.recent)
+            # the oldest key of the first queue that has one besides keep
+            for queue in queues:
+                key = next((k for k in queue if k != keep), None)
+                if key is not None:
+                    break
+            self.bytes -= queue.pop(key)
+            if queue is self.recent:
+                self.ghosts[key] = True
+                if len(self.ghosts) > self.max_ghosts:
+                    self.ghosts.popitem(last=False)
+            evicted.append(key)
+        return evicted
+
+
+# key -> (expiry, pickled value), least recently used first.  Values are
+# kept pickled so a caller mutating what get() returned cannot change the
+# cached copy; a hit costs an unpickle but no round trip.  A value over
+# LOCAL_ITEM_SHARE of max_bytes (file contents, mostly) is not kept, so
+# one large file cannot push out all the metadata.  max_bytes of 0 turns
+# the tier off.
+class LocalCache:
+    LOCAL_ITEM_SHARE = 1.0 / 64
+
+    def __init__(self, max_bytes=LOCAL_BYTES, ttl=LOCAL_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    # (True, value) on a live hit, else (False, None)
+    def get(self, key):
+        with self.lock:
+            hit = self.entries.pop(key, None)
+            if hit is None:
+                return False, None
+            if hit[0] < time.time():
+                self.bytes -= len(hit[1])
+                return False, None
+            self.entries[key] = hit
+        return True, pickle.loads(hit[1])
+
+    def put(self, key, value):
+        if not self.max_bytes:
+            return
+        blob = pickle.dumps(value, 2)
+        with self.lock:
+            self.discard_locked(key)
+            if len(blob) > self.max_bytes * self.LOCAL_ITEM_SHARE:
+                return
+            self.entries[key] = (time.time() + self.ttl, blob)
+            self.bytes += len(blob)
+            while self.bytes > self.max_bytes:
+                self.bytes -= len(self.entries.popitem(last=False)[1][1])
+
+    def discard(self, key):
+        with self.lock:
+            self.discard_locked(key)
+
+    def discard_locked(self, key):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old[1])
+
+
+POLICIES = {"lru": LRUIndex, "2q": TwoQIndex}
+
+# Mount options for the index, taken out of argv: --cache-policy=lru|2q,
+# --cache-entries=N and --cache-bytes=B.  Returns the remaining arguments
+# and the index.
+def index_from_args(argv, max_entries=10, max_bytes=0, policy="lru"):
+    rest = []
+    for arg in argv:
+        if arg.startswith("--cache-policy="):
+            policy = arg.split("=", 1)[1]
+        elif arg.startswith("--cache-entries="):
+            max_entries = int(arg.split("=", 1)[1])
+        elif arg.startswith("--cache-bytes="):
+            max_bytes = int(arg.split("=", 1)[1])
+        else:
+            rest.append(arg)
+    if policy not in POLICIES:
+        raise ValueError("unknown cache policy %r, expected one of %s" %
+                         (policy, ", ".join(sorted(POLICIES))))
+    return rest, POLICIES[policy](max_entries, max_bytes)
+
+
+# Mount options for the in-process tier, taken out of argv: --local-bytes=B
+# and --local-ttl=S.  Returns the remaining arguments and the LocalCache.
+def local_from_args(argv, max_bytes=LOCAL_BYTES, ttl=LOCAL_TTL):
+    rest = []
+    for arg in argv:
+        if arg.startswith("--local-bytes="):
+            max_bytes = int(arg.split("=", 1)[1])
+        elif arg.startswith("--local-ttl="):
+            ttl = float(arg.split("=", 1)[1])
+        else:
+            rest.append(arg)
+    return rest, LocalCache(max_bytes, ttl)
+
+
+# Paths always start with "/", so a hashed name cannot clash with a plain one
+def field_key(path, field):
+    key = "fs:%s:%s" % (field, path)
+    if len(key) > MAX_KEY or _unsafe_key.search(key):
+        key = "fs:%s:#%s" % (field, hashlib.sha1(path).hexdigest())
+    return key
+
+
+def get_cache(servers=DEFAULT_SERVERS):
+    servers = tuple(servers)
+    with _lock:
+        if servers not in _clients:
+            _clients[servers] = KetamaClient(servers)
+        return _clients[servers]
+
+
+class TwoQIndexTest(unittest.TestCase):
+    def fill(self, index, keys):
+        evicted = []
+        for key in keys:
+            evicted += index.add(key)
+        return evicted
+
+    def test_recent_hits(self):
+        index = TwoQIndex(8)
+        index.add("dir")
+        # reading a node twice in a row is still a single use
+        self.assertTrue(index.touch("dir"))
+        self.assertTrue(index.touch("dir"))
+        self.assertTrue("dir" in index.recent, "Promoted on a recent hit")
+        self.assertFalse("dir" in index.entries)
+        self.assertFalse(index.touch("missing"))
+
+    def test_ghost_promotion(self):
+        index = TwoQIndex(8)
+        evicted = self.fill(index, ["key%d" % i for i in range(9)])
+        self.assertEqual(evicted, ["key0"])
+        self.assertTrue("key0" in index.ghosts, "Evicted key not remembered")
+        self.assertFalse("key0" in index)
+        index.add("key0")
+        self.assertTrue("key0" in index.entries, "Ghost not promoted")
+        self.assertFalse("key0" in index.ghosts)
+        self.assertTrue(len(index.ghosts) <= index.max_ghosts)
+
+    def test_scan(self):
+        index = TwoQIndex(8)
+        hot = ["hot%d" % i for i in range(4)]
+        self.fill(index, hot + ["cold%d" % i for i in range(5)])
+        # the cold keys push the hot ones out of recent, used again they
+        # come back from ghosts into entries
+        self.fill(index, hot)
+        self.assertEqual(sorted(index.entries), hot)
+        # a scan that reads every node twice goes through recent only
+        for i in range(50):
+            index.touch("scan%d" % i)
+            index.add("scan%d" % i)
+            index.touch("scan%d" % i)
+        for key in hot:
+            self.assertTrue(index.touch(key), "Scan pushed out %s" % key)
+        self.assertEqual(len(index), 8)
+
+    def test_bytes(self):
+        index = TwoQIndex(100, 100)
+        self.assertEqual(index.add("a", 40), [])
+        self.assertEqual(index.add("b", 40), [])
+        index.update("a", 50)
+        self.assertEqual(index.bytes, 90)
+        self.assertEqual(index.add("c", 30), ["a"])
+        self.assertEqual(index.bytes, 70)
+        index.discard("b")
+        self.assertEqual(index.bytes, 30)
+        self.assertEqual(len(index), 1)
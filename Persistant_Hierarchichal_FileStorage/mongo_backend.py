@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""
+One MongoClient per database url, shared by every FileNode in the process.
+
+A MongoClient owns a connection pool and a server monitoring thread, so one
+built per get/put paid a connection handshake and a server discovery on
+every FS operation.  get_client() builds it once per url with the pool and
+timeout settings below; filenodes() is the collection the FS uses.
+
+NodeStore is the layout of that collection: one document per node,
+
+  {_id: path, meta: blob, data: blob, list_nodes: blob}
+
+each field a blobcodec.dumps() value.  Every lookup is a point read on the
+_id index, writes $set only the fields they change and reads project out
+only the fields they need.  The earlier layout, a document per field or
+per node with the path as a field name, could not be indexed and every
+lookup scanned the collection.
+
+FS operations wrapped in @batched write through a per-thread Batch: every
+put of the operation to the same node is merged into one $set, and all of
+them go to Mongo as one unordered bulk_write when the operation returns.
+Reads inside the operation see its pending writes.  The write concern of
+those writes is set once per mount with set_write_concern().
+
+ChunkStore keeps file contents apart from the node documents, GridFS
+style, in the chunks collection:
+
+  {node: path, n: chunk number, data: CHUNK_SIZE bytes or fewer}
+
+with a unique index on (node, n).  A read or write of a byte range only
+touches the chunks it covers, so files are not bound by the 16 MB document
+limit and large-file I/O costs in proportion to the bytes moved.  Missing
+chunks are holes and read as zeros.
+
+ChunkStoreTest checks the range arithmetic against a bytearray over a
+collection kept in memory: python -m unittest mongo_backend
+"""
+
+import threading, functools, random, unittest
+from collections import OrderedDict
+from pymongo import MongoClient, UpdateOne, ASCENDING
+from pymongo.write_concern import WriteConcern
+from bson.binary import Binary
+
+MAX_POOL_SIZE = 64
+CONNECT_TIMEOUT_MS = 2000
+SOCKET_TIMEOUT_MS = 10000
+SERVER_SELECTION_TIMEOUT_MS = 5000
+# GridFS' default chunk size, keeps a chunk document well under 256 KB
+CHUNK_SIZE = 255 * 1024
+
+_clients = {}
+_stores = {}
+_lock = threading.Lock()
+_local = threading.local()
+# WriteConcern arguments, {} for the server default
+_write_concern = {}
+
+
+def get_client(url):
+    with _lock:
+        client = _clients.get(url)
+        if client is None:
+            client = MongoClient(url,
+                                 maxPoolSize=MAX_POOL_SIZE,
+                                 connectTimeoutMS=CONNECT_TIMEOUT_MS,
+                                 socketTimeoutMS=SOCKET_TIMEOUT_MS,
+                                 serverSelectionTimeoutMS=SERVER_SELECTION_TIMEOUT_MS)
+            _clients[url] = client
+        return client
+
+
+def filenodes(url):
+    return get_client(url).filesys_database.filenodes
+
+
+def chunks(url):
+    return get_client(url).filesys_database.chunks
+
+
+def with_write_concern(collection):
+    if _write_concern:
+        return collection.with_options(write_concern=WriteConcern(**_write_concern))
+    return collection
+
+
+FIELDS = ("meta", "data", "list_nodes")
+
+class NodeStore:
+    def __init__(self, url):
+        self.url = url
+        self.nodes = with_write_concern(filenodes(url))
+
+    # fields is {field: blob}
+    def put(self, path, fields):
+        batch = current_batch()
+        if batch is not None:
+            batch.put(self, path, fields)
+        else:
+            self.nodes.update_one({"_id": path}, {"$set": fields}, upsert=True)
+
+    # {field: blob} holding those of fields the node has, None if there is
+    # no such node
+    def get(self, path, fields=FIELDS):
+        batch = current_batch()
+        pending = batch.pending(self, path) if batch is not None else {}
+        wanted = [field for field in fields if field not in pending]
+        doc = None
+        if wanted:
+            doc = self.nodes.find_one({"_id": path}, dict((field, True) for field in wanted))
+            if doc is not None:
+                del doc["_id"]
+        if not pending:
+            return doc
+        doc = doc or {}
+        for field in fields:
+            if field in pending:
+                doc[field] = pending[field]
+        return doc
+
+
+class ChunkStore:
+    def __init__(self, url):
+        self.chunks = with_write_concern(chunks(url))
+        self.chunks.create_index([("node", ASCENDING), ("n", ASCENDING)], unique=True)
+
+    # {n: bytes} for those of the chunks numbers that exist
+    def load(self, node, numbers):
+        found = self.chunks.find({"node": node, "n": {"$in": list(numbers)}}, {"n": True, "data": True})
+        return dict((doc["n"], str(doc["data"])) for doc in found)
+
+    # size bytes from offset, zero filled past the last chunk; callers keep
+    # the range inside the file
+    def read(self, node, offset, size):
+        if size <= 0:
+            return ""
+        first = offset // CHUNK_SIZE
+        last = (offset + size - 1) // CHUNK_SIZE
+        found = self.chunks.find({"node": node, "n": {"$gte": first, "$lte": last}},
+                                 {"n": True, "data": True}).sort("n", ASCENDING)
+        parts = []
+        pos = first * CHUNK_SIZE
+        for doc in found:
+            start = doc["n"] * CHUNK_SIZE
+            if start > pos:
+                parts.append("\0" * (start - pos))
+            parts.append(str(doc["data"]))
+            pos = start + len(doc["data"])
+        skip = offset - first * CHUNK_SIZE
+        return "".join(parts)[skip:skip + size].ljust(size, "\0")
+
+    # Only the first and last chunks can be partly covered, those are read
+    # and patched; the rest are replaced outright
+    def write(self, node, offset, data):
+        if not data:
+            return
+        end = offset + len(data)
+        first = offset // CHUNK_SIZE
+        last = (end - 1) // CHUNK_SIZE
+        partial = [n for n in set([first, last])
+                   if offset > n * CHUNK_SIZE or end < (n + 1) * CHUNK_SIZE]
+        old = self.load(node, partial) if partial else {}
+        updates = []
+        for n in xrange(first, last + 1):
+            start = n * CHUNK_SIZE
+            lo = max(offset, start) - start
+            hi = min(end, start + CHUNK_SIZE) - start
+            piece = data[start + lo - offset:start + hi - offset]
+            if n in partial:
+                current = old.get(n, "")
+                piece = current[:lo].ljust(lo, "\0") + piece + current[hi:]
+            updates.append(UpdateOne({"node": node, "n": n}, {"$set": {"data": Binary(piece)}}, upsert=True))
+        self.chunks.bulk_write(updates, ordered=False)
+
+    def truncate(self, node, length):
+        last, rest = divmod(length, CHUNK_SIZE)
+        if not rest:
+            self.chunks.delete_many({"node": node, "n": {"$gte": last}})
+            return
+        self.chunks.delete_many({"node": node, "n": {"$gt": last}})
+        current = self.load(node, [last]).get(last)
+        if current is not None and len(current) > rest:
+            self.chunks.update_one({"node": node, "n": last}, {"$set": {"data": Binary(current[:rest])}})
+
+    def delete(self, node):
+        self.chunks.delete_many({"node": node})
+
+
+# One store of each kind per url
+def get_store(kind, url):
+    store = _stores.get((kind, url))
+    if store is None:
+        # built outside the lock, get_client() takes it
+        store = kind(url)
+        with _lock:
+            store = _stores.setdefault((kind, url), store)
+    return store
+
+
+def node_store(url):
+    return get_store(NodeStore, url)
+
+
+def chunk_store(url):
+    return get_store(ChunkStore, url)
+
+
+# w is a number of nodes or "majority", j asks for the journal write too
+def set_write_concern(w=None, j=None):
+    _write_concern.clear()
+    if w is not None:
+        _write_concern["w"] = w
+    if j is not None:
+        _write_concern["j"] = j
+    with _lock:
+        _stores.clear()
+
+
+# Mount options for the writes, taken out of argv: --write-concern=W and
+# --journal.  Returns the remaining arguments.
+def options_from_args(argv):
+    rest = []
+    w = j = None
+    for arg in argv:
+        if arg.startswith("--write-concern="):
+            w = arg.split("=", 1)[1]
+            w = int(w) if w.isdigit() else w
+        elif arg == "--journal":
+            j = True
+        else:
+            rest.append(arg)
+    set_write_concern(w, j)
+    return rest
+
+
+# The writes of one FS operation, (store, path) -> {field: blob} in the
+# order the paths were first written
+class Batch:
+    def __init__(self):
+        self.writes = OrderedDict()
+
+    def put(self, store, path, fields):
+        self.writes.setdefault((store, path), {}).update(fields)
+
+    def pending(self, store, path):
+        return self.writes.get((store, path), {})
+
+    # Every node is one update, so their order does not matter and the
+    # server may apply them in parallel
+    def flush(self):
+        ops = OrderedDict()
+        for (store, path), fields in self.writes.iteritems():
+            ops.setdefault(store, []).append(UpdateOne({"_id": path}, {"$set": fields}, upsert=True))
+        self.writes = OrderedDict()
+        for store, updates in ops.iteritems():
+            store.nodes.bulk_write(updates, ordered=False)
+
+
+def current_batch():
+    return getattr(_local, "batch", None)
+
+
+# Run an FS operation with its writes batched; a nested call joins the
+# batch of the outer one.  What was written is flushed even if the
+# operation fails half way, as it was when every put went out at once.
+def batched(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if current_batch() is not None:
+            return func(*args, **kwargs)
+        _local.batch = Batch()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            batch = _local.batch
+            _local.batch = None
+            batch.flush()
+    return wrapper
+
+
+# The chunks collection in a dict of (node, n) -> data, answering just the
+# queries ChunkStore makes
+class FakeChunks:
+    def __init__(self):
+        self.docs = {}
+        self.finds = 0
+
+    def matches(self, query, key):
+        if key[0] != query["node"]:
+            return False
+        cond = query.get("n")
+        n = key[1]
+        if cond is None:
+            return True
+        if not isinstance(cond, dict):
+            return n == cond
+        return (n in cond.get("$in", [n]) and n >= cond.get("$gte", n) and
+                n > cond.get("$gt", n - 1) and n <= cond.get("$lte", n))
+
+    def find(self, query, projection=None):
+        self.finds += 1
+        return FakeCursor({"n": key[1], "data": data} for key, data in self.docs.items()
+                          if self.matches(query, key))
+
+    def update_one(self, query, update, upsert=False):
+        key = (query["node"], query["n"])
+        if upsert or key in self.docs:
+            self.docs[key] = update["$set"]["data"]
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            self.update_one(request._filter, request._doc, request._upsert)
+
+    def delete_many(self, query):
+        for key in [key for key in self.docs if self.matches(query, key)]:
+            del self.docs[key]
+
+
+class FakeCursor(list):
+    def sort(self, key, direction=ASCENDING):
+        return FakeCursor(sorted(self, key=lambda doc: doc[key], reverse=direction != ASCENDING))
+
+
+class FakeChunkStore(ChunkStore):
+    def __init__(self):
+        self.chunks = FakeChunks()
+
+
+class ChunkStoreTest(unittest.TestCase):
+    def setUp(self):
+        global CHUNK_SIZE
+        self.chunk_size = CHUNK_SIZE
+        CHUNK_SIZE = 8
+        self.store = FakeChunkStore()
+
+    def tearDown(self):
+        global CHUNK_SIZE
+        CHUNK_SIZE = self.chunk_size
+
+    def test_write(self):
+        store = self.store
+        store.write("/f", 4, "abcdefghij")
+        self.assertEqual(sorted(store.chunks.docs), [("/f", 0), ("/f", 1)])
+        self.assertEqual(store.read("/f", 0, 14), "\0\0\0\0abcdefghij")
+        self.assertEqual(store.read("/f", 6, 3), "cde", "Bad read across chunks")
+        # a write covering whole chunks does not read them first
+        finds = store.chunks.finds
+        store.write("/f", 8, "X" * 16)
+        self.assertEqual(store.chunks.finds, finds, "Whole chunks read back")
+        self.assertEqual(store.read("/f", 0, 24), "\0\0\0\0abcd" + "X" * 16)
+        # holes read as zeros
+        store.write("/f", 40, "end")
+        self.assertEqual(store.read("/f", 22, 21), "XX" + "\0" * 16 + "end")
+        store.delete("/f")
+        self.assertEqual(store.chunks.docs, {})
+
+    def test_model(self):
+        store = self.store
+        rand = random.Random(2015)
+        model = bytearray()
+        store.write("/other", 0, "keep")
+        for i in xrange(2000):
+            op = rand.random()
+            if op < 0.6:
+                offset = rand.randint(0, len(model) + 20)
+                data = "".join(chr(rand.randint(97, 122)) for j in xrange(rand.randint(0, 30)))
+                store.write("/f", offset, data)
+                if offset > len(model):
+                    model.extend("\0" * (offset - len(model)))
+                model[offset:offset + len(data)] = data
+            elif op < 0.8:
+                length = rand.randint(0, len(model) + 20)
+                store.truncate("/f", length)
+                del model[length:]
+                model.extend("\0" * (length - len(model)))
+            else:
+                offset = rand.randint(0, len(model))
+                size = rand.randint(0, len(model) - offset)
+                self.assertEqual(store.read("/f", offset, size), str(model[offset:offset + size]),
+                                 "Read of %d at %d differs after %d ops" % (size, offset, i))
+            for (node, n), data in store.chunks.docs.items():
+                self.assertTrue(len(data) <= CHUNK_SIZE, "Chunk %d over size" % n)
+        self.assertEqual(store.read("/f", 0, len(model)), str(model))
+        self.assertEqual(store.read("/other", 0, 4), "keep", "Another node's chunks changed")